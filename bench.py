@@ -0,0 +1,464 @@
+"""Benchmarks for hot paths of the simulation and for full network runs.
+
+Run all of them with `python bench.py` or only some with `python bench.py <name> ...`. Results
+can be saved as a JSON baseline with `--save` and later runs can be checked against it with
+`--compare`, which flags every result that got worse by more than the tolerance and exits with
+status 1 if there are any. Baselines are only comparable when taken on the same machine, and
+shared or throttled machines may need a higher `--tolerance`.
+
+Every benchmark runs in a fresh interpreter, as peers are numbered per process and a process
+should only ever build one network that it simulates (see `sim.run`).
+"""
+import argparse
+from collections import Counter
+import json
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import random
+import resource
+import sys
+import time
+import timeit
+import traceback
+import tracemalloc
+
+import simpy
+
+from channels import Channel, calc_channel_charge
+import config
+import logs
+from main import (
+    AnnounceItems,
+    Peer,
+    RequestItems,
+    SecretShare,
+    SendItems,
+    Transaction,
+    calc_charge,
+    charge_channel,
+)
+from networks import full_network
+
+
+# units of results for which a higher value is better, for all others lower is better
+HIGHER_IS_BETTER = {'events/s', 'x'}
+
+
+def current_rss():
+    """Resident set size of the current process in bytes."""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def peak_rss():
+    """Highest resident set size of the current process so far in bytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def time_per_call(function, number=None, repeat=5):
+    """Best time per call out of several repetitions in seconds.
+
+    By default, the number of calls per repetition is chosen so that each takes at least 0.2 s.
+    """
+    timer = timeit.Timer(function)
+    if number is None:
+        number, _ = timer.autorange()
+    return min(timer.repeat(number=number, repeat=repeat)) / number
+
+
+def run_in_process(function, *args):
+    """Run a function in a new interpreter so that it starts from a clean state.
+
+    Raises a `RuntimeError` with the traceback of the worker if the function fails, or if the
+    worker dies without a result.
+    """
+    # spawn rather than fork, so that nothing carries over from networks built in this process
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=put_result, args=(results, function) + args)
+    process.start()
+    while True:
+        try:
+            error, result = results.get(timeout=1)
+            break
+        except queue.Empty:
+            if process.is_alive():
+                continue
+            # a result sent just before exiting may only be readable now
+            try:
+                error, result = results.get(timeout=1)
+                break
+            except queue.Empty:
+                raise RuntimeError('worker exited with code {} without a result'.format(
+                    process.exitcode
+                ))
+    process.join()
+    if error is not None:
+        raise RuntimeError('{} failed in a worker process:\n{}'.format(function.__name__, error))
+    return result
+
+
+def put_result(results, function, *args):
+    """Put `(None, result)` or `(traceback, None)` of a function call on a queue."""
+    try:
+        result = function(*args)
+    except BaseException:
+        results.put((traceback.format_exc(), None))
+        raise
+    results.put((None, result))
+
+
+class CountingEnvironment(simpy.Environment):
+    """Simulation environment that counts the events it processes by type."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.processed_events = Counter()
+
+    def step(self):
+        if self._queue:
+            self.processed_events[self._queue[0][3].__class__.__name__] += 1
+        super().step()
+
+
+def make_timeline(n_segments, bandwidth):
+    """A timeline in the list format of `main.calc_charge` with one segment per second."""
+    timeline = [
+        (bandwidth if i % 2 else bandwidth / 2, i + 1)
+        for i in range(n_segments - 1)
+    ]
+    timeline.append((bandwidth, math.inf))
+    return timeline
+
+
+def make_channel(timeline):
+    channel = Channel(timeline[-1][0])
+    channel.available = [available for available, _ in timeline]
+    channel.ends = [end for _, end in timeline]
+    return channel
+
+
+def bench_channels():
+    """Bandwidth calculations for a message in the middle of timelines of increasing length."""
+    results = {}
+    bandwidth = config.MBIT
+    message_size = bandwidth  # takes a bit more than a second, so spans about two segments
+    for n_segments in (1, 10, 100, 1000, 10000):
+        timelines = [make_timeline(n_segments, bandwidth) for _ in range(2)]
+        channels = [make_channel(timeline) for timeline in timelines]
+        start_time = n_segments / 2 + 0.25
+        charge = calc_charge(message_size, timelines, start_time)
+        n = max(10, 10000 // n_segments)
+        copies = [make_channel(timelines[0]) for _ in range(5 * n)]
+        timings = [
+            ('calc_charge', lambda: calc_charge(message_size, timelines, start_time)),
+            ('calc_channel_charge', lambda: calc_channel_charge(
+                message_size,
+                channels,
+                start_time
+            )),
+            ('charge_channel', lambda: charge_channel(timelines[0], charge)),
+            ('Channel.charge', lambda: copies.pop().charge(charge)),
+        ]
+        for name, function in timings:
+            # charging changes the channel, so every call gets a fresh copy
+            duration = time_per_call(function, n if name == 'Channel.charge' else None)
+            results['{} {} segments'.format(name, n_segments)] = (duration * 1e6, 'us')
+    return results
+
+
+def bench_distributor(store_sizes=(1000, 10000, 100000, 1000000)):
+    """Distributor operations depending on the number of stored items."""
+    results = {}
+    logs.silence()
+    for store_size in store_sizes:
+        env = simpy.Environment()
+        peer = Peer(env, 1, 1)
+        neighbour = Peer(env, 1, 1)
+        items = [Transaction(i // 100) for i in range(store_size)]
+        for item in items:
+            peer.distributor.distribute(item)
+        sample = random.sample(items, 10)
+        request = RequestItems([hash(item) for item in sample])
+        announcement = AnnounceItems(sample)
+        block = sample[0].block
+        new_items = iter([Transaction(store_size // 100) for _ in range(5 * 10000)])
+
+        timings = [
+            ('distribute', lambda: peer.distributor.distribute(next(new_items)), 10000),
+            ('request for 10 items', lambda: peer.distributor.handle_message(
+                request,
+                neighbour
+            ), None),
+            ('announcement of 10 items', lambda: peer.distributor.handle_message(
+                announcement,
+                neighbour
+            ), None),
+            ('find_items of a block', lambda: peer.distributor.find_items(
+                [Transaction.type_id],
+                block,
+                set()
+            ), None),
+        ]
+        for name, function, n in timings:
+            duration = time_per_call(function, n)
+            results['{} {} items'.format(name, store_size)] = (duration * 1e6, 'us')
+    return results
+
+
+def bench_topology():
+    """Time needed to set up the default network with an increasing number of users."""
+    results = {}
+    logs.silence()
+    default_n_users = config.N_USERS
+    for n_users in (100, 1000, 10000):
+        config.N_USERS = n_users
+        duration = time_per_call(lambda: full_network(simpy.Environment()), 1)
+        results['full_network {} users'.format(n_users)] = (duration * 1e3, 'ms')
+    config.N_USERS = default_n_users
+    return results
+
+
+def bench_items(n=100000):
+    """Memory footprint of items and throughput of set operations and message sizes."""
+    results = {}
+    factories = {
+        'Transaction': lambda i: Transaction(0),
+        'SecretShare': lambda i: SecretShare(i // 100, i % 100, 0),
+    }
+    for name, factory in factories.items():
+        tracemalloc.start()
+        items = [factory(i) for i in range(n)]
+        memory = tracemalloc.get_traced_memory()[0] - sys.getsizeof(items)
+        tracemalloc.stop()
+
+        first = set(items[:n * 3 // 4])
+        second = set(items[n // 4:])
+        message = SendItems(items[:100])
+        timings = [
+            ('set construction', lambda: set(items), n),
+            ('set difference', lambda: first - second, len(first)),
+            ('set union', lambda: first | second, len(first) + len(second)),
+            ('equality', lambda: [a == b for a, b in zip(items, items[1:])], n - 1),
+            ('message size', lambda: message.size, len(message.items)),
+        ]
+        results['{} memory'.format(name)] = (memory / n, 'bytes')
+        for operation, function, n_operations in timings:
+            duration = time_per_call(function, 10)
+            results['{} {}'.format(name, operation)] = (duration / n_operations * 1e9, 'ns')
+    return results
+
+
+def bench_events(duration=100):
+    """Number of events processed per simulated second in the default scenario."""
+    logs.silence()
+    env = CountingEnvironment()
+    users, collator, keypers, validators = full_network(env)
+    network = users + [collator] + keypers + validators
+    for peer in network:
+        peer.start()
+    env.run(duration)
+    results = {'all events': (sum(env.processed_events.values()) / duration, 'events/sim s')}
+    for event_type, n in env.processed_events.most_common():
+        results[event_type] = (n / duration, 'events/sim s')
+    duplicate_bytes = sum(peer.distributor.duplicate_download_bytes for peer in network)
+    results['downloaded more than once'] = (duplicate_bytes / duration, 'bytes/sim s')
+    return results
+
+
+def measure_memory(retention_blocks, duration, sample_interval):
+    """RSS and number of stored items after every `sample_interval` simulated seconds."""
+    config.RETENTION_BLOCKS = retention_blocks
+    logs.silence()
+    env = simpy.Environment()
+    users, collator, keypers, validators = full_network(env)
+    network = users + [collator] + keypers + validators
+    for peer in network:
+        peer.start()
+    samples = []
+    for sample_time in range(sample_interval, duration + 1, sample_interval):
+        env.run(sample_time)
+        stored_items = sum(len(peer.distributor.fetched_items) for peer in network)
+        samples.append((sample_time, current_rss(), stored_items))
+    return samples, peak_rss()
+
+
+def bench_memory(duration=600, sample_interval=120):
+    """Memory used over simulated time, with and without forgetting about old blocks.
+
+    With a retention policy, RSS and stored items should level off after the first blocks
+    instead of growing with the length of the run.
+    """
+    results = {}
+    for retention_blocks in (None, 2):
+        samples, max_rss = run_in_process(
+            measure_memory,
+            retention_blocks,
+            duration,
+            sample_interval
+        )
+        name = 'retaining {} blocks'.format(
+            'all' if retention_blocks is None else retention_blocks
+        )
+        for sample_time, rss, stored_items in samples:
+            results['{} RSS at {} s'.format(name, sample_time)] = (rss / 2**20, 'MiB')
+            results['{} stored items at {} s'.format(name, sample_time)] = (stored_items, 'items')
+        results[name + ' peak RSS'] = (max_rss / 2**20, 'MiB')
+    return results
+
+
+def measure_run(n_users, duration, log_level=None):
+    config.N_USERS = n_users
+    if log_level is None:
+        logs.silence()
+    else:
+        logs.configure(log_level, stream=open(os.devnull, 'w'))
+    env = CountingEnvironment()
+    users, collator, keypers, validators = full_network(env)
+    for peer in users + [collator] + keypers + validators:
+        peer.start()
+    start_time = time.perf_counter()
+    env.run(duration)
+    wall_time = time.perf_counter() - start_time
+    events = sum(env.processed_events.values())
+    return wall_time, events / wall_time, peak_rss()
+
+
+def bench_logging(duration=50):
+    """Events processed per second of wall time with logging to /dev/null and without logging."""
+    results = {}
+    for name, log_level in (('debug', logging.DEBUG), ('info', logging.INFO), ('quiet', None)):
+        _, events_per_second, _ = run_in_process(measure_run, config.N_USERS, duration, log_level)
+        results[name] = (events_per_second, 'events/s')
+    return results
+
+
+def bench_scaling(duration=10):
+    """Full runs of the default scenario with an increasing number of users."""
+    results = {}
+    for n_users in (100, 1000, 10000):
+        wall_time, events_per_second, rss = run_in_process(measure_run, n_users, duration)
+        results['{} users wall time'.format(n_users)] = (wall_time, 's')
+        results['{} users events'.format(n_users)] = (events_per_second, 'events/s')
+        results['{} users peak RSS'.format(n_users)] = (rss / 2**20, 'MiB')
+    return results
+
+
+def measure_parallel(n_partitions, n_users, duration, latency):
+    config.N_USERS = n_users
+    config.LATENCY = latency
+    config.CONNECTION_MODEL = 'store_and_forward'
+    config.PARTITIONS = n_partitions
+    import parallel
+    summary, _ = parallel.run(duration)
+    return summary['wall_time'], summary['windows']
+
+
+def bench_parallel(n_users=1000, duration=10, latency=0.05):
+    """Partitioned runs with more users and some latency, split into an increasing number of parts.
+
+    The speedup is relative to a single partition, which runs in a worker process as well. It is
+    limited by the number of cores.
+    """
+    results = {}
+    single_wall_time = None
+    for n_partitions in (1, 2, 4, 8):
+        wall_time, n_windows = run_in_process(
+            measure_parallel,
+            n_partitions,
+            n_users,
+            duration,
+            latency
+        )
+        single_wall_time = single_wall_time or wall_time
+        results['{} partitions wall time'.format(n_partitions)] = (wall_time, 's')
+        results['{} partitions speedup'.format(n_partitions)] = (single_wall_time / wall_time, 'x')
+        results['{} partitions windows'.format(n_partitions)] = (n_windows, 'windows')
+    return results
+
+
+BENCHMARKS = {
+    # micro-benchmarks
+    'channels': bench_channels,
+    'distributor': bench_distributor,
+    'topology': bench_topology,
+    'items': bench_items,
+    # macro-benchmarks
+    'events': bench_events,
+    'memory': bench_memory,
+    'logging': bench_logging,
+    'scaling': bench_scaling,
+    'parallel': bench_parallel,
+}
+
+
+def compare(results, baseline, tolerance):
+    """Print the change of every result relative to a baseline and return the regressions."""
+    regressions = []
+    for benchmark, benchmark_results in results.items():
+        print(benchmark)
+        for name, (value, unit) in benchmark_results.items():
+            if name not in baseline.get(benchmark, {}):
+                continue
+            baseline_value, _ = baseline[benchmark][name]
+            if baseline_value == 0:
+                # no relative change, but anything appearing where there was none is worse
+                change = math.inf if value > 0 else 0
+                worse = 0 if unit in HIGHER_IS_BETTER else change
+            else:
+                change = value / baseline_value - 1
+                worse = -change if unit in HIGHER_IS_BETTER else change
+            is_regression = worse > tolerance
+            if is_regression:
+                regressions.append((benchmark, name))
+            print('{:>50}: {:12.4g} -> {:12.4g} {:<12} {:+7.1%}{}'.format(
+                name,
+                baseline_value,
+                value,
+                unit,
+                change,
+                '  REGRESSION' if is_regression else ''
+            ))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('names', nargs='*', metavar='name', help=', '.join(BENCHMARKS))
+    parser.add_argument('--save', metavar='FILE', help='store the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results to a baseline')
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.2,
+        help='relative change for a result to count as a regression (default: 0.2)'
+    )
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark {!r}'.format(name))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = {}
+    for name in args.names or BENCHMARKS:
+        results[name] = run_in_process(BENCHMARKS[name])
+        if baseline is None:
+            print(name)
+            for result_name, (value, unit) in results[name].items():
+                print('{:>50}: {:12.4g} {}'.format(result_name, value, unit))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('{} regressions'.format(len(regressions)))
+            sys.exit(1)
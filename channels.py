@@ -0,0 +1,140 @@
+from bisect import bisect_left, bisect_right
+import math
+
+
+class Channel(object):
+    """Bandwidth available on one side of a link (the uplink or downlink of a peer) over time.
+
+    The timeline is stored as two parallel lists of breakpoints: `available[i]` is the bandwidth
+    that is available until `ends[i]` (and after `ends[i - 1]`). The last segment always lasts
+    until infinity. Segments that lie completely in the past are pruned lazily: `start` is the
+    index of the first segment that is still relevant and the lists are only shortened once enough
+    dead segments have accumulated.
+    """
+
+    compaction_threshold = 64
+
+    def __init__(self, bandwidth):
+        self.bandwidth = bandwidth
+        self.available = [bandwidth]
+        self.ends = [math.inf]
+        self.start = 0
+
+    def __len__(self):
+        return len(self.ends) - self.start
+
+    def __iter__(self):
+        return zip(self.available[self.start:], self.ends[self.start:])
+
+    def is_idle(self):
+        """True iff nothing is reserved on this channel from now on."""
+        return len(self.ends) - self.start == 1
+
+    def prune(self, time):
+        """Forget about all segments that end before a certain time."""
+        self.start = bisect_left(self.ends, time, self.start)
+        if self.start >= self.compaction_threshold and 2 * self.start >= len(self.ends):
+            del self.available[:self.start]
+            del self.ends[:self.start]
+            self.start = 0
+
+    def segment_index(self, time):
+        """Index of the segment that contains a certain point in time."""
+        return bisect_right(self.ends, time, self.start)
+
+    def charge(self, charge):
+        """Reserve bandwidth on this channel in place.
+
+        `charge` is the additionally used bandwidth in the format returned by `calc_channel_charge`.
+        The resulting timeline is the same as the one `main.charge_channel` would build.
+        """
+        available = self.available
+        ends = self.ends
+        start_time = charge[0][1]
+
+        i = self.segment_index(start_time)
+        new_available = []
+        new_ends = []
+        if i == 0 or ends[i - 1] != start_time:
+            # split the segment the transmission starts in
+            new_available.append(available[i])
+            new_ends.append(start_time)
+
+        j = i
+        for added, added_until in charge[1:]:
+            while True:
+                remaining = available[j] - added
+                assert remaining >= 0
+                until = min(added_until, ends[j])
+                assert not new_ends or until > new_ends[-1]
+                new_available.append(remaining)
+                new_ends.append(until)
+                if added_until < ends[j]:
+                    break
+                j += 1
+                if added_until == ends[j - 1]:
+                    break
+
+        available[i:j] = new_available
+        ends[i:j] = new_ends
+
+
+def calc_channel_charge(message_size, channels, start_time):
+    """Calculate the additional bandwidth used to transmit a message over a set of channels.
+
+    This computes the same result as `main.calc_charge`, but operates on `Channel` objects. The
+    segment that contains `start_time` is found by bisection and only the segments that overlap
+    with the transmission are visited afterwards.
+    """
+    # fast path: nothing reserved on any channel, so the transmission runs at full speed
+    if all(channel.is_idle() for channel in channels):
+        bandwidth = min(channel.available[-1] for channel in channels)
+        if message_size <= 0 or math.isclose(message_size, 0, abs_tol=0.1):
+            return [(0, start_time)]
+        if bandwidth > 0:
+            return [(0, start_time), (bandwidth, start_time + message_size / bandwidth)]
+
+    not_transmitted = message_size
+    time = start_time
+    charge = [(0, start_time)]
+
+    indices = [channel.segment_index(start_time) for channel in channels]
+
+    while not_transmitted > 0 and not math.isclose(not_transmitted, 0, abs_tol=0.1):
+        # get available bandwidth for each channel at current time
+        bandwidth = math.inf
+        next_bandwidth_change = math.inf
+        for n, channel in enumerate(channels):
+            i = indices[n]
+            ends = channel.ends
+            while ends[i] <= time:
+                i += 1
+            indices[n] = i
+            bandwidth = min(bandwidth, channel.available[i])
+            next_bandwidth_change = min(next_bandwidth_change, ends[i])
+
+        # transmit until either transmission is finished or bandwidth changes
+        if bandwidth == 0:
+            charge_until = next_bandwidth_change
+        else:
+            charge_until = min(
+                next_bandwidth_change,
+                time + not_transmitted / bandwidth
+            )
+        charge.append((bandwidth, charge_until))
+        not_transmitted -= bandwidth * (charge_until - time)
+        time = charge_until
+    return charge
+
+
+def reserve(message_size, channels, start_time):
+    """Reserve the bandwidth needed to transmit a message and return the time it arrives."""
+    charge = calc_channel_charge(message_size, channels, start_time)
+    for channel in channels:
+        channel.charge(charge)
+    return charge[-1][1]
+
+
+def earliest_completion(message_size, channels, start_time):
+    """Time at which a message sent now would arrive, without reserving anything."""
+    return calc_channel_charge(message_size, channels, start_time)[-1][1]
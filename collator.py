@@ -1,5 +1,7 @@
+from collections import defaultdict
 from itertools import count
 from main import Message, Peer, Service, Collation, Transaction
+import metrics
 
 
 class Collator(Peer):
@@ -18,7 +20,7 @@ class CollationService(Service):
         super().__init__(env, peer)
         self.collation_interval = collation_interval
         self.next_collation_block = 0
-        self.collation_size = 0
+        self.collation_sizes = defaultdict(int)  # number of transactions by block
 
     def start(self):
         transaction_watcher = self.env.process(self.watch_transactions())
@@ -26,30 +28,30 @@ class CollationService(Service):
         yield self.env.all_of([transaction_watcher, collation_creator])
 
     def watch_transactions(self):
-        current_block = self.next_collation_block
-        processed = set()
+        distributor = self.peer.distributor
+        subscription = distributor.subscribe(Transaction.type_id, None)
+        transactions = distributor.find_items([Transaction.type_id], None, set())
         while True:
-            if current_block != self.next_collation_block:
-                processed = set()
-                self.collation_size = 0
-                current_block += 1
-            transactions = yield self.env.process(self.peer.distributor.get_items(
-                Transaction.type_id,
-                current_block,
-                exclude=processed
-            ))
-            self.collation_size += len(transactions - processed)
-            processed |= transactions
+            for transaction in transactions:
+                if transaction.block >= self.next_collation_block:
+                    self.collation_sizes[transaction.block] += transaction.count
+            transactions = yield from subscription.next_items()
 
     def create_collations(self):
         while True:
             yield self.env.timeout(self.collation_interval)
+            collation_size = self.collation_sizes.pop(self.next_collation_block, 0)
             self.logger.info(
                 'creating collation',
                 block=self.next_collation_block,
-                txs=self.collation_size,
+                txs=collation_size,
                 time=self.env.now
             )
-            collation = Collation(self.next_collation_block, self.peer.instance_number)
+            collation = Collation(
+                self.next_collation_block,
+                self.peer.instance_number,
+                collation_size
+            )
             self.peer.distributor.distribute(collation)
+            self.record(metrics.COLLATION_CREATED, self.next_collation_block)
             self.next_collation_block += 1
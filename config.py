@@ -2,13 +2,61 @@ SEED = 0
 KBIT = 1024 / 8
 MBIT = 1024 * KBIT
 
+# 'reservation': messages reserve bandwidth up front in the order in which they are sent
+# 'fair_share': concurrent messages share the bandwidth of a link in a max-min fair way
+BANDWIDTH_MODEL = 'reservation'
+
+# s, time every message takes in addition to its transmission (reservation model only)
+LATENCY = 0
+
+# how messages pass a connection (reservation model only):
+# 'cut_through': over the uplink of the sender and the downlink of the receiver at the same time
+# 'store_and_forward': over the uplink and, after the latency, over the downlink of the receiver.
+#     Each end of a connection only knows about the messages it sends or receives itself, so
+#     partitioned runs (see `PARTITIONS`), which need this model, give the same results as
+#     unpartitioned ones
+CONNECTION_MODEL = 'cut_through'
+
+ANNOUNCE_INTERVAL = 1  # s, minimum time between two rounds of announcements or requests
+REQUEST_TIMEOUT = 10  # s, time after which an item is requested again if it hasn't arrived
+
+# how items are passed on to neighbours, by item type, e.g. {'Vote': ('push', None)}:
+# 'pull': announce items and let neighbours request them (the default for unlisted types)
+# ('push', None): send items right away to all neighbours without announcing them (a smaller
+#     fanout is rejected, as items wouldn't reach every peer and the protocol would stall)
+# ('hybrid', fanout): push items to `fanout` neighbours and announce them to all others
+# 'route': pass items on only along a shortest path to their receiver (the default for addressed
+#     items, i.e. secret shares), see `routing`
+DISSEMINATION_STRATEGIES = {}
+
 N_USERS = 100
 USER_UPLINK = 0.1 * MBIT
 USER_DOWNLINK = 1 * MBIT
 N_USER_CONNECTIONS = 5
 
+# how peers are connected, each with about N_USER_CONNECTIONS others:
+# 'random': every peer connects to random others until it has N_USER_CONNECTIONS
+# 'random_regular': random graph in which (almost) all peers have the same number of connections
+# ('watts_strogatz', rewiring probability): small world graph
+# 'barabasi_albert': scale-free graph grown by preferential attachment
+TOPOLOGY = 'random'
+CONNECT_KEYPERS = False  # additionally connect all keypers with each other
+CONNECT_VALIDATORS = False  # additionally connect all validators with each other
+# prefix of the files to load topologies from, or to store them in if they don't exist yet (None
+# to not cache them), e.g. '/tmp/topology'; every combination of the topology settings, SEED and
+# network size gets its own file with a digest of them as suffix, see `topology`
+TOPOLOGY_FILE = None
+
 TX_RATE = 10.  # tx/s, globally
 TX_SIZE = 100
+# transactions users send at once as a single item, to simulate high rates with fewer items
+TX_BUNDLE_SIZE = 1
+# how the times at which users send transactions are generated:
+# 'periodic': every user sends at constant intervals, starting at a random offset
+# 'poisson': a single scheduler creates the transactions of all users as one Poisson process,
+#     each from a random user (much less scheduling overhead for many users)
+# ('gamma', shape): like 'poisson', but with gamma distributed gaps between arrivals
+TX_ARRIVALS = 'periodic'
 COLLATION_INTERVAL = 10
 
 COLLATOR_UPLINK = 10 * MBIT
@@ -18,9 +66,27 @@ COLLATION_INTERVAL = 5  # s
 
 N_KEYPERS = 10
 KEYPER_THRESHOLD = 7
+# number of blocks a keyper generates keys for at the same time
+KEYPER_PIPELINE_DEPTH = 1
 KEYPER_UPLINK = 0.1 * MBIT
 KEYPER_DOWNLINK = 1 * MBIT
 N_KEYPER_CONNECTIONS = 5
 
 VALIDATOR_UPLINK = 0.1 * MBIT
 VALIDATOR_DOWNLINK = 1 * MBIT
+# votes needed in addition to the collation for finality (None for a majority of the keypers)
+FINALITY_VOTES = None
+
+# file to write a binary trace of all messages to (None to not record one), see `tracing`
+TRACE_FILE = None
+
+# s, time after their creation after which items that haven't reached all peers stop being
+# tracked and count as not reaching them, see `propagation`
+PROPAGATION_WINDOW = 60
+
+# number of partitions to split the network into, each simulated by its own process (1 to run
+# everything in this process), see `parallel`
+PARTITIONS = 1
+
+# number of blocks to keep items for, counting back from the latest final block (None keeps all)
+RETENTION_BLOCKS = None
@@ -0,0 +1,225 @@
+from itertools import count
+import heapq
+import math
+from weakref import WeakKeyDictionary
+
+
+class Link(object):
+    """One side of a connection (the uplink or downlink of a peer) shared by concurrent flows."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.flows = set()
+        self.allocated = 0  # sum of the rates of all flows
+
+
+class Flow(object):
+    """A message in transmission over a set of links."""
+
+    def __init__(self, size, links, done, now):
+        self.remaining = size
+        self.links = links
+        self.done = done  # event that succeeds once the message has been transmitted completely
+        self.rate = 0
+        self.updated = now  # time at which `remaining` was last brought up to date
+        self.version = 0  # incremented whenever the completion time changes
+        self.finished = False
+
+
+class FlowNetwork(object):
+    """Bandwidth model in which concurrent flows share links in a max-min fair way.
+
+    In contrast to the reservation model of `channels` no bandwidth is allocated up front. Instead,
+    rates are recomputed whenever a flow starts or ends, starting with the flows on the links of
+    that flow and spreading only as far as rates actually change (see `reallocate`), which keeps
+    the work per message independent of the size of the network. Completion times are kept in a
+    heap and a single timer event is scheduled for the earliest one.
+    """
+
+    networks = WeakKeyDictionary()
+
+    def __init__(self, env):
+        self.env = env
+        self.completions = []  # heap of (completion time, sequence number, version, flow)
+        self.sequence = count()
+        self.timer_time = math.inf
+        self.timer_generation = 0
+
+    @classmethod
+    def for_env(cls, env):
+        """Get the flow network shared by all peers in a simulation environment."""
+        if env not in cls.networks:
+            cls.networks[env] = cls(env)
+        return cls.networks[env]
+
+    def start_flow(self, size, links):
+        """Start transmitting a message of a certain size over a set of links."""
+        flow = Flow(size, links, self.env.event(), self.env.now)
+        if size <= 0 or math.isclose(size, 0, abs_tol=0.1):
+            flow.finished = True
+            flow.done.succeed()
+            return flow
+        for link in links:
+            link.flows.add(flow)
+        self.reallocate(links)
+        return flow
+
+    def estimate_transmission_time(self, size, links):
+        """Time a new flow would take if the rates of all flows stayed as they are now."""
+        rate = min(link.capacity / (len(link.flows) + 1) for link in links)
+        return size / rate
+
+    def reallocate(self, links):
+        """Recompute the rates of flows after a flow has started or ended on a set of links.
+
+        The flows on a growing set of links get the max-min fair allocation, given the bandwidth
+        the flows elsewhere use on the other links they traverse. The set grows until no rate
+        outside of it can change, by
+        - the other links of flows whose rate has decreased, as flows there may take over the
+          bandwidth released, and
+        - links on which a flow is limited by flows outside the set that have a higher rate and
+          have to give up bandwidth for the allocation to be fair.
+        """
+        now = self.env.now
+        links = set(links)
+        added_links = links
+        while added_links:
+            rates, bottlenecks = self.fair_rates(links, now)
+            added_links = set()
+            for flow, rate in rates.items():
+                if rate < flow.rate * (1 - 1e-9):
+                    added_links.update(link for link in flow.links if link not in links)
+                bottleneck = bottlenecks[flow]
+                if bottleneck not in links and any(
+                    other.rate > rate * (1 + 1e-9)
+                    for other in bottleneck.flows if other not in rates
+                ):
+                    added_links.add(bottleneck)
+            for flow, rate in rates.items():
+                self.set_rate(flow, rate, now)
+            links |= added_links
+        self.schedule_timer()
+
+    def fair_rates(self, links, now):
+        """Max-min fair rates of the flows on a set of links, with all other flows fixed.
+
+        Returns the rates and, for each flow, the link that limits it.
+        """
+        flows = set()
+        for link in links:
+            flows |= link.flows
+
+        # account for the progress made at the old rates and find out how much bandwidth is left
+        # for these flows on each link
+        capacities = {}
+        unfrozen = {}
+        for flow in flows:
+            flow.remaining -= flow.rate * (now - flow.updated)
+            flow.updated = now
+            for link in flow.links:
+                if link not in capacities:
+                    capacities[link] = link.capacity - link.allocated
+                    unfrozen[link] = 0
+                capacities[link] += flow.rate
+                unfrozen[link] += 1
+
+        # progressive filling: repeatedly saturate the link offering the smallest fair share
+        link_numbers = {}
+        shares = []
+        for n, (link, capacity) in enumerate(capacities.items()):
+            link_numbers[link] = n
+            capacities[link] = max(capacity, 0)
+            shares.append((capacities[link] / unfrozen[link], n, link))
+        heapq.heapify(shares)
+        rates = {}
+        bottlenecks = {}
+        while shares:
+            share, n, link = heapq.heappop(shares)
+            if not unfrozen[link] or share != capacities[link] / unfrozen[link]:
+                continue  # outdated entry
+            touched_links = set()
+            for flow in link.flows:
+                if flow in rates or flow not in flows:
+                    continue
+                rates[flow] = share
+                bottlenecks[flow] = link
+                for other_link in flow.links:
+                    capacities[other_link] -= share
+                    unfrozen[other_link] -= 1
+                    touched_links.add(other_link)
+            for other_link in touched_links:
+                if unfrozen[other_link]:
+                    capacity = max(capacities[other_link], 0)
+                    capacities[other_link] = capacity
+                    heapq.heappush(shares, (
+                        capacity / unfrozen[other_link],
+                        link_numbers[other_link],
+                        other_link
+                    ))
+        return rates, bottlenecks
+
+    def set_rate(self, flow, rate, now):
+        """Change the rate of a flow and reschedule its completion."""
+        if math.isclose(rate, flow.rate, rel_tol=1e-9):
+            return  # not worth rescheduling (differences in rounding only)
+        for link in flow.links:
+            link.allocated += rate - flow.rate
+        flow.rate = rate
+        flow.version += 1
+        if rate > 0:
+            completion_time = now + max(flow.remaining, 0) / rate
+            entry = (completion_time, next(self.sequence), flow.version, flow)
+            heapq.heappush(self.completions, entry)
+
+    def schedule_timer(self):
+        """Make sure the timer fires at the earliest completion time."""
+        completions = self.completions
+        while completions and self.is_outdated(completions[0]):
+            heapq.heappop(completions)
+        if not completions:
+            return
+        completion_time = completions[0][0]
+        if completion_time >= self.timer_time:
+            return
+        self.timer_time = completion_time
+        self.timer_generation += 1
+        timer = self.env.timeout(max(completion_time - self.env.now, 0))
+        generation = self.timer_generation
+        timer.callbacks.append(lambda event: self.on_timer(generation))
+
+    def on_timer(self, generation):
+        if generation != self.timer_generation:
+            return  # a timer for an earlier completion has been scheduled in the meantime
+        self.timer_time = math.inf
+        now = self.env.now
+
+        finished_flows = []
+        completions = self.completions
+        while completions:
+            entry = completions[0]
+            if self.is_outdated(entry):
+                heapq.heappop(completions)
+            elif entry[0] <= now or math.isclose(entry[0], now):
+                heapq.heappop(completions)
+                finished_flows.append(entry[3])
+            else:
+                break
+
+        changed_links = set()
+        for flow in finished_flows:
+            flow.finished = True
+            for link in flow.links:
+                link.flows.discard(flow)
+                link.allocated -= flow.rate
+                changed_links.add(link)
+        if changed_links:
+            self.reallocate(changed_links)
+        else:
+            self.schedule_timer()
+        for flow in finished_flows:
+            flow.done.succeed()
+
+    @staticmethod
+    def is_outdated(entry):
+        _, _, version, flow = entry
+        return flow.finished or version != flow.version
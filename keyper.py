@@ -1,6 +1,9 @@
 from collections import defaultdict, namedtuple
 from itertools import chain, count
 import random
+
+import config
+import metrics
 from main import (
     Peer,
     Service,
@@ -21,17 +24,25 @@ class Keyper(Peer):
 
     def __init__(self, env, uplink, downlink, threshold):
         super().__init__(env, uplink, downlink)
+        self.address = self.instance_number  # secret shares are addressed to keyper ids
         self.keyper_ids.append(self.instance_number)
         self.threshold_encryption_service = ThresholdEncryptionService(env, self, threshold)
         self.services.append(self.threshold_encryption_service)
 
 
 class ThresholdEncryptionProtocol():
+    """State of the key generation of one keyper for one block.
+
+    Received items are checked once when they are added, and the senders seen so far are kept
+    per phase, so that checking whether a phase is finished doesn't depend on the number of
+    items.
+    """
 
-    def __init__(self, k, all_ids, my_id):
+    def __init__(self, k, all_ids, my_id, block):
         self.n = len(all_ids)
         self.k = k
         self.my_id = my_id
+        self.block = block
         self.all_ids = set(all_ids)
         self.other_ids = self.all_ids - set([self.my_id])
 
@@ -41,33 +52,49 @@ class ThresholdEncryptionProtocol():
         self.enc_key_shares = set()
         # self.keypers_with_dec_key_share = set()
 
+        # other keypers from which we have received the items of each phase
+        self.secret_share_senders = set()
+        self.witness_senders = set()
+        self.nonce_senders = set()
+
+    def add_secret_share(self, secret_share):
+        assert secret_share.block == self.block
+        assert secret_share.receiver == self.my_id  # secret shares should be addressed to us
+        assert secret_share.sender in self.other_ids
+        self.secret_shares.add(secret_share)
+        self.secret_share_senders.add(secret_share.sender)
+
+    def add_witness(self, witness):
+        assert witness.block == self.block
+        assert witness.sender in self.other_ids
+        self.witnesses.add(witness)
+        self.witness_senders.add(witness.sender)
+
+    def add_nonce(self, nonce):
+        assert nonce.block == self.block
+        assert nonce.sender in self.other_ids
+        self.nonces.add(nonce)
+        self.nonce_senders.add(nonce.sender)
+
     def key_distribution_finished(self):
-        # all messages should be for the same block
-        if not self.secret_shares:
-            return False
-        block = next(secret_share.block for secret_share in self.secret_shares)
-        assert all(secret_share.block == block for secret_share in self.secret_shares)
-        assert all(witness.block == block for witness in self.witnesses)
-        # secret shares should be addressed to us
-        assert all(secret_share.receiver == self.my_id for secret_share in self.secret_shares)
-        # key distribution is finished as soon as secret 
-        secret_share_senders = set(secret_share.sender for secret_share in self.secret_shares)
-        witness_senders = set(witness.sender for witness in self.witnesses)
-        assert self.my_id not in secret_share_senders
-        assert self.my_id not in witness_senders
-        return secret_share_senders == witness_senders == self.other_ids
+        # key distribution is finished as soon as we have secret shares and witnesses from all
+        # other keypers
+        n_others = len(self.other_ids)
+        return len(self.secret_share_senders) == len(self.witness_senders) == n_others
 
     def nonce_collection_finished(self):
-        block = next((nonce.block for nonce in self.nonces), None)
-        assert all(nonce.block == block for nonce in self.nonces)
-        nonce_senders = set(nonce.sender for nonce in self.nonces)
-        assert self.my_id not in nonce_senders
         if not self.key_distribution_finished():
             return False
-        return set(nonce.sender for nonce in self.nonces) == self.other_ids
+        return len(self.nonce_senders) == len(self.other_ids)
 
 
 class ThresholdEncryptionService(Service):
+    """Runs the key generation for one block after another.
+
+    With `config.KEYPER_PIPELINE_DEPTH` > 1, the key generation for up to that many blocks runs
+    at the same time, so that the rounds for the next blocks overlap with waiting for the
+    collation of the current one.
+    """
 
     def __init__(self, env, peer, k):
         super().__init__(env, peer)
@@ -75,106 +102,121 @@ class ThresholdEncryptionService(Service):
         self.all_ids = None  # will be set once all keypers have been initialized (in `start`)
         self.my_id = self.peer.instance_number
         self.protocols_by_block = {}
-        self.current_block = 0
+        self.pipeline_depth = config.KEYPER_PIPELINE_DEPTH
+        self.current_block = 0  # the oldest block for which we haven't sent a dec key share yet
 
     def start(self):
         self.all_ids = set(self.peer.keyper_ids)  # now all keypers are initialized
-        while True:
-            # start with next protocol
-            self.logger.info('kicking of protocol', block=self.current_block, time=self.env.now)
-            protocol = ThresholdEncryptionProtocol(self.k, self.all_ids, self.my_id)
-            self.protocols_by_block[self.current_block] = protocol
-            assert self.current_protocol is protocol
-
-            self.send_secrets()
-            yield self.env.process(self.collect_secrets())
-            self.send_nonce()
-            yield self.env.process(self.collect_nonces())
-            self.send_enc_key_share()
-            yield self.env.process(self.wait_for_collation())
-            self.send_dec_key_share()
-
-            self.current_block += 1
-
-    def send_secrets(self):
+        running = []  # processes of the blocks in the pipeline, oldest first
+        for block in count():
+            if self.pipeline_depth == 1:
+                # no need for a process per block, which would delay each start by an event
+                yield from self.run_protocol(block)
+                self.current_block += 1
+                continue
+            if len(running) == self.pipeline_depth:
+                yield running.pop(0)
+                self.current_block += 1
+            running.append(self.env.process(self.run_protocol(block)))
+
+    def run_protocol(self, block):
+        """Generate the keys for a block and send the dec key share once its collation is there."""
+        self.logger.info('kicking of protocol', block=block, time=self.env.now)
+        protocol = ThresholdEncryptionProtocol(self.k, self.all_ids, self.my_id, block)
+        self.protocols_by_block[block] = protocol
+        self.record(metrics.KEYPER_STARTED, block)
+
+        self.send_secrets(protocol)
+        yield self.env.process(self.collect_secrets(protocol))
+        self.record(metrics.SECRETS_COLLECTED, block)
+        self.send_nonce(protocol)
+        yield self.env.process(self.collect_nonces(protocol))
+        self.record(metrics.NONCES_COLLECTED, block)
+        self.send_enc_key_share(protocol)
+        yield self.env.process(self.wait_for_collation(protocol))
+        self.send_dec_key_share(protocol)
+
+    def send_secrets(self, protocol):
         """Send secret shares and witness."""
-        self.logger.info('sending secrets', block=self.current_block, time=self.env.now)
-        assert not self.current_protocol.key_distribution_finished()
+        self.logger.info('sending secrets', block=protocol.block, time=self.env.now)
+        assert not protocol.key_distribution_finished()
         for other_id in self.all_ids:
             if other_id == self.my_id:
                 continue
-            secret_share = SecretShare(self.current_block, self.my_id, other_id)
+            secret_share = SecretShare(protocol.block, self.my_id, other_id)
             self.peer.distributor.distribute(secret_share)
-        witness = Witness(self.current_block, self.my_id)
+        witness = Witness(protocol.block, self.my_id)
         self.peer.distributor.distribute(witness)
 
-    def collect_secrets(self):
+    def collect_secrets(self, protocol):
         """Collect secret shares and witness from all other keypers."""
-        self.logger.info('waiting for secrets', block=self.current_block, time=self.env.now)
-        assert not self.current_protocol.key_distribution_finished()
+        self.logger.info('waiting for secrets', block=protocol.block, time=self.env.now)
+        assert not protocol.key_distribution_finished()
         processed_items = set()
         # collect all secret shares and witnesses
-        while not self.current_protocol.key_distribution_finished():
+        while not protocol.key_distribution_finished():
             items = yield self.env.process(self.peer.distributor.get_items(
                 (SecretShare.type_id, Witness.type_id),
-                self.current_block,
+                protocol.block,
                 exclude=processed_items
             ))
-            secret_shares = set(item for item in items
-                                if isinstance(item, SecretShare) and item.receiver == self.my_id)
-            witnesses = set(item for item in items
-                            if isinstance(item, Witness) and item.sender != self.my_id)
-            self.current_protocol.secret_shares |= secret_shares
-            self.current_protocol.witnesses |= witnesses
+            for item in items:
+                if isinstance(item, SecretShare):
+                    if item.receiver == self.my_id:
+                        protocol.add_secret_share(item)
+                elif item.sender != self.my_id:
+                    protocol.add_witness(item)
             processed_items |= items
 
-    def send_nonce(self):
+    def send_nonce(self, protocol):
         """Send my nonce to other keypers."""
-        self.logger.info('sending nonce', block=self.current_block, time=self.env.now)
-        assert not self.current_protocol.nonce_collection_finished()
-        nonce = Nonce(self.current_block, self.my_id)
+        self.logger.info('sending nonce', block=protocol.block, time=self.env.now)
+        assert not protocol.nonce_collection_finished()
+        nonce = Nonce(protocol.block, self.my_id)
         self.peer.distributor.distribute(nonce)
 
-    def collect_nonces(self):
+    def collect_nonces(self, protocol):
         """Collect nonces from all other keypers"""
-        self.logger.info('waiting for nonces', block=self.current_block, time=self.env.now)
-        assert not self.current_protocol.nonce_collection_finished()
+        self.logger.info('waiting for nonces', block=protocol.block, time=self.env.now)
+        assert not protocol.nonce_collection_finished()
         processed_nonces = set()
-        while not self.current_protocol.nonce_collection_finished():
+        while not protocol.nonce_collection_finished():
             items = yield self.env.process(self.peer.distributor.get_items(
                 Nonce.type_id,
-                self.current_block,
+                protocol.block,
                 exclude=processed_nonces
             ))
-            nonces = set(item for item in items if item.sender != self.my_id)
-            self.current_protocol.nonces |= nonces
+            for nonce in items:
+                if nonce.sender != self.my_id:
+                    protocol.add_nonce(nonce)
             processed_nonces |= items
 
-    def send_enc_key_share(self):
+    def send_enc_key_share(self, protocol):
         """Send the encryption key share."""
-        self.logger.info('sending enc key share', block=self.current_block, time=self.env.now)
-        assert self.current_protocol.nonce_collection_finished()
-        enc_key_share = EncKeyShare(self.current_block, self.peer.instance_number)
+        self.logger.info('sending enc key share', block=protocol.block, time=self.env.now)
+        assert protocol.nonce_collection_finished()
+        enc_key_share = EncKeyShare(protocol.block, self.peer.instance_number)
         self.peer.distributor.distribute(enc_key_share)
 
-    def wait_for_collation(self):
-        """Wait for the collation for the current block."""
-        self.logger.info('waiting for collation', block=self.current_block, time=self.env.now)
+    def wait_for_collation(self, protocol):
+        """Wait for the collation for the block of a protocol."""
+        self.logger.info('waiting for collation', block=protocol.block, time=self.env.now)
         collations = set()
         while not collations:
             collations = yield self.env.process(self.peer.distributor.get_items(
                 Collation.type_id,
-                self.current_block
+                protocol.block
             ))
             assert len(collations) <= 1
 
-    def send_dec_key_share(self):
+    def send_dec_key_share(self, protocol):
         """Send the decryption key share."""
-        self.logger.info('sending dec key share', block=self.current_block, time=self.env.now)
-        assert self.current_protocol.nonce_collection_finished()
-        dec_key_share = DecKeyShare(self.current_block, self.peer.instance_number)
+        self.logger.info('sending dec key share', block=protocol.block, time=self.env.now)
+        assert protocol.nonce_collection_finished()
+        dec_key_share = DecKeyShare(protocol.block, self.peer.instance_number)
         self.peer.distributor.distribute(dec_key_share)
 
-    @property
-    def current_protocol(self):
-        return self.protocols_by_block.get(self.current_block, None)
+    def forget_blocks_before(self, block):
+        # blocks from the current one on are still in the pipeline
+        for old_block in [b for b in self.protocols_by_block if b < min(block, self.current_block)]:
+            del self.protocols_by_block[old_block]
@@ -0,0 +1,85 @@
+"""Loggers that cost next to nothing when they are disabled.
+
+Whether a logger is enabled is decided once, when it is created for a peer or service, based on
+the level and filters passed to `configure`. Disabled loggers are replaced by `NULL_LOGGER`
+whose methods do nothing and which is falsy, so that call sites that need to compute expensive
+values for a log entry can skip that with `if logger: ...`. Levels below the configured one are
+filtered by structlog before any event dict is built.
+"""
+import logging
+import sys
+
+import structlog
+
+
+class NullLogger(object):
+    """Stand-in for a disabled logger."""
+
+    def __bool__(self):
+        return False
+
+    def bind(self, **new_values):
+        return self
+
+    def _log(self, event=None, **kw):
+        pass
+
+    debug = info = warning = error = exception = msg = _log
+
+
+NULL_LOGGER = NullLogger()
+
+level = logging.INFO
+node_filter = None  # called with each peer, loggers are only created for peers it accepts
+service_filter = None  # called with each service name
+
+
+def configure(
+    new_level=logging.INFO,
+    nodes=None,
+    services=None,
+    stream=sys.stdout,
+    colors=True
+):
+    """Enable logging of the given level and above to a stream.
+
+    Only has an effect on peers created afterwards. `nodes` and `services` are optional
+    functions that select the peers and service names to log for.
+    """
+    global level, node_filter, service_filter
+    level, node_filter, service_filter = new_level, nodes, services
+    logging.basicConfig(stream=stream, level=new_level)
+    structlog.configure(
+        processors=[
+            structlog.processors.StackInfoRenderer(),
+            structlog.processors.format_exc_info,
+            structlog.dev.ConsoleRenderer(colors=colors)
+        ],
+        wrapper_class=structlog.make_filtering_bound_logger(new_level),
+        logger_factory=structlog.stdlib.LoggerFactory()
+    )
+
+
+def silence():
+    """Disable all loggers created from now on."""
+    global level
+    level = logging.CRITICAL + 1
+
+
+def get_logger(node, service=None, log_level=logging.INFO):
+    """Get a logger for a peer or one of its services.
+
+    `log_level` is the level the caller is going to log at. If messages of that level are filtered
+    out, or the peer or service is, `NULL_LOGGER` is returned.
+    """
+    if log_level < level:
+        return NULL_LOGGER
+    if node_filter is not None and not node_filter(node):
+        return NULL_LOGGER
+    if service is not None and service_filter is not None and not service_filter(service):
+        return NULL_LOGGER
+    logger = structlog.get_logger(node.__class__.__name__ + str(node.instance_number))
+    logger = logger.bind(node=node)
+    if service is not None:
+        logger = logger.bind(service=service)
+    return logger
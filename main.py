@@ -1,13 +1,22 @@
 from collections import defaultdict, namedtuple
 from collections.abc import Container
-from itertools import count, dropwhile
+from functools import partial
+from itertools import count
+import logging
 import math
-import random
+from weakref import WeakKeyDictionary
 
+from channels import Channel, earliest_completion, reserve
 import config
+from flows import FlowNetwork, Link
+import logs
+from metrics import Metrics
+from propagation import PropagationTracker
+from routing import Routes
+from tracing import Tracer, RECEIVE, SEND
+import rng
 
-from simpy.events import AllOf
-import structlog
+from simpy.events import AllOf, Event, URGENT
 
 
 BLOCK_NUMBER_SIZE = 4
@@ -18,66 +27,89 @@ SIGNATURE_SIZE = 132
 
 class Message(object):
 
+    __slots__ = ('size',)
     base_size = 20
 
-    @property
-    def size(self):
-        return self.base_size
+    def __init__(self):
+        self.size = self.base_size
 
 
 class AnnounceItems(Message):
 
+    __slots__ = ('items',)
+
     def __init__(self, items):
+        super().__init__()
         self.items = items
-
-    @property
-    def size(self):
-        return super().size + len(self.items) * (BLOCK_NUMBER_SIZE + ITEM_HASH_SIZE)
+        self.size += len(self.items) * (BLOCK_NUMBER_SIZE + ITEM_HASH_SIZE)
 
 
 class RequestItems(Message):
 
+    __slots__ = ('hashes',)
+
     def __init__(self, hashes):
+        super().__init__()
         self.hashes = hashes
-
-    @property
-    def size(self):
-        return super().size + len(self.hashes) * ITEM_HASH_SIZE
+        self.size += len(self.hashes) * ITEM_HASH_SIZE
 
 
 class SendItems(Message):
 
+    __slots__ = ('items',)
+
     def __init__(self, items):
+        super().__init__()
         self.items = items
-
-    @property
-    def size(self):
-        return super().size + sum(item.size for item in self.items)
+        self.size += sum(item.size for item in self.items)
 
 
 class Item(object):
+    """A piece of data distributed through the network.
+
+    Items are immutable. They are identified by their hash which is computed once from `identity`
+    when they are created.
+    """
 
+    __slots__ = ('block', 'hash_')
     item_type_counter = count()
     size = BLOCK_NUMBER_SIZE + ITEM_HASH_SIZE
 
     def __init__(self, block):
-        self.block = block
+        object.__setattr__(self, 'block', block)
+        object.__setattr__(self, 'hash_', hash(self.identity()))
+
+    def identity(self):
+        raise NotImplementedError()
+
+    def __setattr__(self, name, value):
+        raise AttributeError('{} is immutable'.format(self.__class__.__name__))
+
+    def __setstate__(self, state):
+        # restore the slots when unpickled, e.g. after being sent to another partition
+        _, slots = state
+        for name, value in slots.items():
+            object.__setattr__(self, name, value)
+
+    def __hash__(self):
+        return self.hash_
 
     def __eq__(self, other):
-        return hash(self) == hash(other)
+        return self is other or self.hash_ == hash(other)
 
 
 class SignedItem(Item):
     """Item with a sender address and signature."""
 
+    __slots__ = ('sender',)
     size = Item.size + SIGNATURE_SIZE
 
     def __init__(self, block, sender):
+        object.__setattr__(self, 'sender', sender)
         super().__init__(block)
-        self.sender = sender
 
-    def __hash__(self):
-        return hash((self.__class__.type_id, self.block, self.sender))
+    def identity(self):
+        return (self.__class__.type_id, self.block, self.sender)
 
     def __repr__(self):
         return '<{} block={} sender={}>'.format(self.__class__.__name__, self.block, self.sender)
@@ -86,14 +118,15 @@ class SignedItem(Item):
 class AddressedItem(SignedItem):
     """Item with both a sender and a receiver address."""
 
+    __slots__ = ('receiver',)
     size = SignedItem.size + ADDRESS_SIZE
 
     def __init__(self, block, sender, receiver):
+        object.__setattr__(self, 'receiver', receiver)
         super().__init__(block, sender)
-        self.receiver = receiver
 
-    def __hash__(self):
-        return hash((self.__class__.type_id, self.block, self.sender, self.receiver))
+    def identity(self):
+        return (self.__class__.type_id, self.block, self.sender, self.receiver)
 
     def __repr__(self):
         return '<{} block={} sender={} receiver={}>'.format(
@@ -105,59 +138,96 @@ class AddressedItem(SignedItem):
 
 
 class Transaction(Item):
+    """A transaction or, if `count` is larger than one, a bundle of transactions of one user."""
 
-    size = Item.size + 100
+    __slots__ = ('nonce', 'count')
     type_id = next(Item.item_type_counter)
 
-    def __init__(self, block):
+    def __init__(self, block, nonce=None, count=1):
+        if nonce is None:
+            nonce = rng.stream('transactions').randint(0, 2**32)
+        object.__setattr__(self, 'nonce', nonce)
+        object.__setattr__(self, 'count', count)
         super().__init__(block)
-        self.hash_ = random.randint(0, 2**32)
 
-    def __hash__(self):
-        return self.hash_
+    @property
+    def size(self):
+        return Item.size + config.TX_SIZE * self.count
+
+    def identity(self):
+        return self.nonce
 
 
 class SecretShare(AddressedItem):
 
+    __slots__ = ()
     size = AddressedItem.size + 2 * 32
     type_id = next(Item.item_type_counter)
 
 
 class Witness(SignedItem):
 
+    __slots__ = ()
     size = SignedItem.size + 32
     type_id = next(Item.item_type_counter)
 
 
 class Nonce(SignedItem):
 
+    __slots__ = ()
     size = SignedItem.size + 32
     type_id = next(Item.item_type_counter)
 
 
 class EncKeyShare(SignedItem):
 
+    __slots__ = ()
     size = SignedItem.size + 32
     type_id = next(Item.item_type_counter)
 
 
 class DecKeyShare(SignedItem):
 
+    __slots__ = ()
     size = SignedItem.size + 32
     type_id = next(Item.item_type_counter)
 
 
 class Vote(SignedItem):
 
+    __slots__ = ()
     size = SignedItem.size + 32
     type_id = next(Item.item_type_counter)
 
 
 class Collation(SignedItem):
 
-    size = Item.size + config.TX_SIZE * config.TX_RATE *  config.COLLATION_INTERVAL
+    __slots__ = ('n_transactions',)
     type_id = next(Item.item_type_counter)
 
+    def __init__(self, block, sender, n_transactions=0):
+        object.__setattr__(self, 'n_transactions', n_transactions)
+        super().__init__(block, sender)
+
+    @property
+    def size(self):
+        return Item.size + config.TX_SIZE * self.n_transactions
+
+
+ITEM_TYPES = {
+    item_type.__name__: item_type
+    for item_type in (
+        Transaction,
+        SecretShare,
+        Witness,
+        Nonce,
+        EncKeyShare,
+        DecKeyShare,
+        Vote,
+        Collation,
+    )
+}
+
 
 def calc_charge(message_size, channels, start_time):
     """Calculate the additional bandwidth used to transmit a message of certain size.
@@ -251,31 +321,57 @@ def charge_channel(channel, charge):
 
 
 def expected_transmission_time(message_size, channels, start_time):
-    charge = calc_charge(message_size, channels, start_time)
-    return charge[-1][1] - start_time
+    return earliest_completion(message_size, channels, start_time) - start_time
 
 
 class Peer(object):
     """A node in the network."""
 
     instance_counter = count()
+    node_counter = count()  # shared by all kinds of peers, unlike `instance_counter`
+    address = None  # where addressed items for this peer are routed to, see `routing`
 
     def __init__(self, env, uplink, downlink):
         self.instance_number = next(self.instance_counter)
+        self.node_id = next(Peer.node_counter)
         self.env = env
         self.peers = []
 
-        self.logger = structlog.get_logger(self.__class__.__name__ + str(self.instance_number))
-        self.logger = self.logger.bind(node=self)
+        self.logger = logs.get_logger(self)
 
         self.max_uplink = uplink
         self.max_downlink = downlink
 
-        # [(available bandwidth, available until), ...]
-        self.uplink_channel = [(self.max_uplink, math.inf)]
-        self.downlink_channel = [(self.max_downlink, math.inf)]
+        self.bandwidth_model = config.BANDWIDTH_MODEL
+        self.latency = config.LATENCY
+        self.connection_model = config.CONNECTION_MODEL
+        if self.bandwidth_model == 'reservation':
+            self.uplink_channel = Channel(self.max_uplink)
+            self.downlink_channel = Channel(self.max_downlink)
+            if self.connection_model == 'store_and_forward':
+                self.handovers = Handovers.for_env(self.env)
+                self.transmission_counter = count()  # orders our messages handed over at once
+            elif self.connection_model != 'cut_through':
+                raise ValueError('unknown connection model {!r}'.format(self.connection_model))
+        elif self.bandwidth_model == 'fair_share':
+            self.flow_network = FlowNetwork.for_env(self.env)
+            self.uplink_link = Link(self.max_uplink)
+            self.downlink_link = Link(self.max_downlink)
+            if self.connection_model != 'cut_through':
+                raise ValueError('the fair share model only supports cut through connections')
+        else:
+            raise ValueError('unknown bandwidth model {!r}'.format(self.bandwidth_model))
 
         self.transmission_events_by_peer = defaultdict(list)
+        self.download_events_by_peer = defaultdict(list)  # store and forward only
+        self.idle_events_by_peer = {}
+
+        self.tracer = None
+        if config.TRACE_FILE is not None:
+            self.tracer = Tracer.for_env(self.env, config.TRACE_FILE)
+        # in partitioned runs, the partition simulating this peer (`None` for peers of other
+        # processes), see `parallel`
+        self.partition = None
 
         self.distributor = ItemDistributorService(self.env, self)
         self.services = [self.distributor]
@@ -290,25 +386,103 @@ class Peer(object):
 
     def send(self, message, receiver):
         """Send a message to a connected peer."""
-        charge = calc_charge(
-            message.size,
-            [self.uplink_channel, receiver.downlink_channel],
-            self.env.now
-        )
-        self.uplink_channel = charge_channel(self.uplink_channel, charge)
-        receiver.downlink_channel = charge_channel(receiver.downlink_channel, charge)
-        past_predicate = lambda t: t[1] < self.env.now
-        self.uplink_channel = list(dropwhile(past_predicate, self.uplink_channel))
-        receiver.downlink_channel = list(dropwhile(past_predicate, receiver.downlink_channel))
-        arrival_time = charge[-1][1]
-        transmission_event = self.env.timeout(arrival_time - self.env.now)
+        if self.tracer is not None:
+            self.tracer.record_message(SEND, message, self, receiver)
+        transmission_event, = self.transmit(message, [receiver])
         self.transmission_events_by_peer[receiver].append(transmission_event)
         yield transmission_event
         self.transmission_events_by_peer[receiver].remove(transmission_event)
-        receiver.receive(message, self)
+        if self.connection_model == 'cut_through':
+            receiver.receive(message, self)
+        self.notify_if_idle(receiver)
+
+    def broadcast(self, message, receivers):
+        """Send the same message to several connected peers.
+
+        The transmissions to all receivers are started in a single pass, in the order in which the
+        receivers are given, so every receiver gets the message at the same time as if `send` had
+        been called for each of them one after another.
+        """
+        if self.tracer is not None:
+            for receiver in receivers:
+                self.tracer.record_message(SEND, message, self, receiver)
+        transmission_events = self.transmit(message, receivers)
+        for receiver, transmission_event in zip(receivers, transmission_events):
+            self.transmission_events_by_peer[receiver].append(transmission_event)
+            transmission_event.callbacks.append(partial(self.deliver, message, receiver))
+        yield self.env.all_of(list(dict.fromkeys(transmission_events)))
+
+    def deliver(self, message, receiver, transmission_event):
+        """Hand a fully transmitted message over to its receiver."""
+        self.transmission_events_by_peer[receiver].remove(transmission_event)
+        if self.connection_model == 'cut_through':
+            receiver.receive(message, self)
+        self.notify_if_idle(receiver)
+
+    def transmit(self, message, receivers):
+        """Start transmitting a message to a list of connected peers.
+
+        Returns an event for each receiver that fires once the message has arrived. With the
+        reservation model, bandwidth is reserved for all receivers in one pass and only one event
+        is scheduled per distinct arrival time.
+
+        With store and forward, the events fire once the message has left our uplink and the
+        latency has passed. The message is then handed over to the downlink of the receiver, by
+        `Handovers` or, if another partition simulates the receiver, by `parallel.Partition`.
+        """
+        message_size = message.size
+        if self.bandwidth_model == 'fair_share':
+            return [
+                self.flow_network.start_flow(
+                    message_size,
+                    [self.uplink_link, receiver.downlink_link]
+                ).done
+                for receiver in receivers
+            ]
+
+        now = self.env.now
+        self.uplink_channel.prune(now)
+        transmission_events_by_arrival_time = {}
+        transmission_events = []
+        for receiver in receivers:
+            if self.connection_model == 'store_and_forward':
+                arrival_time = reserve(message_size, [self.uplink_channel], now) + self.latency
+                sequence = next(self.transmission_counter)
+                if receiver.partition is self.partition:
+                    self.handovers.add(arrival_time, sequence, message, self, receiver)
+                else:
+                    self.partition.hand_over(arrival_time, sequence, message, self, receiver)
+            else:
+                receiver.downlink_channel.prune(now)
+                arrival_time = reserve(
+                    message_size,
+                    [self.uplink_channel, receiver.downlink_channel],
+                    now
+                ) + self.latency
+            if arrival_time not in transmission_events_by_arrival_time:
+                transmission_event = self.env.timeout(arrival_time - now)
+                transmission_events_by_arrival_time[arrival_time] = transmission_event
+            transmission_events.append(transmission_events_by_arrival_time[arrival_time])
+        return transmission_events
+
+    def download(self, message, sender):
+        """Transmit a message that has left the uplink of a sender over our downlink."""
+        now = self.env.now
+        self.downlink_channel.prune(now)
+        arrival_time = reserve(message.size, [self.downlink_channel], now)
+        download_event = self.env.timeout(arrival_time - now)
+        self.download_events_by_peer[sender].append(download_event)
+        download_event.callbacks.append(partial(self.finish_download, message, sender))
+
+    def finish_download(self, message, sender, download_event):
+        self.download_events_by_peer[sender].remove(download_event)
+        self.receive(message, sender)
+        self.notify_if_idle(sender)
 
     def receive(self, message, sender):
         """Called when a message to this peer has been fully transmitted."""
+        if self.tracer is not None:
+            self.tracer.record_message(RECEIVE, message, sender, self)
         for service in self.services:
             service.handle_message(message, sender)
 
@@ -326,16 +500,126 @@ class Peer(object):
         return bool(self.transmission_events_by_peer[peer])
 
     def is_connection_busy(self, peer):
-        """True iff a message is sent between this peer and another, no matter the direction."""
+        """True iff a message is sent between this peer and another, no matter the direction.
+
+        With store and forward, only our end of the connection counts, i.e. messages on our
+        uplink or downlink, as the other end may be simulated by another partition.
+        """
+        if self.connection_model == 'store_and_forward':
+            return self.is_sending_to(peer) or bool(self.download_events_by_peer[peer])
         return self.is_sending_to(peer) or peer.is_sending_to(self)
 
+    def estimate_download_time(self, message_size, sender):
+        """Time it would take a connected peer to send us a message if it started now."""
+        if self.bandwidth_model == 'fair_share':
+            return self.flow_network.estimate_transmission_time(
+                message_size,
+                [sender.uplink_link, self.downlink_link]
+            )
+        if self.connection_model == 'store_and_forward':
+            # the uplink of the sender is only known at its end, so assume it's idle
+            self.downlink_channel.prune(self.env.now)
+            return message_size / sender.max_uplink + sender.latency + expected_transmission_time(
+                message_size,
+                [self.downlink_channel],
+                self.env.now
+            )
+        sender.uplink_channel.prune(self.env.now)
+        self.downlink_channel.prune(self.env.now)
+        return expected_transmission_time(
+            message_size,
+            [sender.uplink_channel, self.downlink_channel],
+            self.env.now
+        )
+
+    def wait_until_idle(self, peer):
+        """Get an event that succeeds once the connection to another peer is not busy anymore."""
+        if peer not in self.idle_events_by_peer:
+            self.idle_events_by_peer[peer] = self.env.event()
+        return self.idle_events_by_peer[peer]
+
+    def notify_if_idle(self, peer):
+        """Notify the processes on both ends waiting for the connection to become idle.
+
+        With store and forward, only the processes on our end.
+        """
+        if self.is_connection_busy(peer):
+            return
+        ends = ((self, peer),)
+        if self.connection_model == 'cut_through':
+            ends += ((peer, self),)
+        for waiting_peer, other_peer in ends:
+            idle_event = waiting_peer.idle_events_by_peer.pop(other_peer, None)
+            if idle_event is not None:
+                idle_event.succeed()
+
+
+class Handover(Event):
+    """Event at a point in time that is processed before all others at that time."""
+
+    def __init__(self, env, delay):
+        super().__init__(env)
+        self._ok = True
+        self._value = None
+        env.schedule(self, URGENT, delay)
+
+
+class Handovers(object):
+    """Messages that have left the uplinks of their senders, by the time they reach the downlinks.
+
+    All messages handed over at the same time are passed to the downlinks of their receivers in
+    one go, ordered by sender and order of sending, before any other event at that time. So the
+    order doesn't depend on when a message was handed over here, which makes partitioned runs,
+    where messages from other partitions are handed over later, give the same results as
+    unpartitioned ones (see `parallel`). Only used with the store and forward connection model.
+    """
+
+    handovers = WeakKeyDictionary()
+
+    def __init__(self, env):
+        self.env = env
+        self.messages_by_time = {}  # {time: [(sender id, sequence, message, sender, receiver)]}
+
+    @classmethod
+    def for_env(cls, env):
+        """Get the handovers of a simulation environment."""
+        if env not in cls.handovers:
+            cls.handovers[env] = cls(env)
+        return cls.handovers[env]
+
+    def add(self, time, sequence, message, sender, receiver):
+        """Pass a message to the downlink of its receiver at a point in time."""
+        if time not in self.messages_by_time:
+            self.messages_by_time[time] = []
+            Handover(self.env, time - self.env.now).callbacks.append(partial(self.download, time))
+        self.messages_by_time[time].append((sender.node_id, sequence, message, sender, receiver))
+
+    def download(self, time, _):
+        for _, _, message, sender, receiver in sorted(
+            self.messages_by_time.pop(time),
+            key=lambda handover: handover[:2]
+        ):
+            receiver.download(message, sender)
+
+
+def finality_votes():
+    """Number of votes a block needs in addition to its collation to become final."""
+    if config.FINALITY_VOTES is None:
+        return config.N_KEYPERS // 2 + 1
+    return config.FINALITY_VOTES
+
 
 class Service(object):
 
     def __init__(self, env, peer):
         self.env = env
         self.peer = peer
-        self.logger = self.peer.logger.bind(service=self.__class__.__name__)
+        self.logger = logs.get_logger(self.peer, self.__class__.__name__)
+        self.metrics = Metrics.for_env(env)
+
+    def record(self, event, block):
+        """Record a protocol event (one of the codes in `metrics`) for a block at this peer."""
+        self.metrics.record(event, block, self.peer.instance_number)
 
     def handle_message(self, message, sender):
         pass
@@ -343,6 +627,121 @@ class Service(object):
     def start(self):
         pass
 
+    def forget_blocks_before(self, block):
+        """Called once state for blocks before a certain one is not needed anymore."""
+        pass
+
+
+class DisseminationStrategy(object):
+    """Defines how newly fetched items of a certain type are passed on to the neighbours of a peer.
+
+    Items are either announced to neighbours which then request them, pushed directly to some
+    neighbours, or both.
+    """
+
+    announce = True
+    routed = False  # whether items are routed towards their receiver instead of spread
+
+    def __init__(self, fanout=None):
+        self.fanout = fanout  # number of neighbours to push to, `None` for all
+
+    @classmethod
+    def from_config(cls, spec):
+        """Create a strategy from a config entry such as `'pull'` or `('hybrid', 3)`.
+
+        Pure push only with all neighbours: with a smaller fanout, some peers would never get
+        the items, as nothing announces them, and the protocol would stall.
+        """
+        if isinstance(spec, str):
+            spec = (spec,)
+        name, *args = spec
+        strategy = DISSEMINATION_STRATEGIES[name](*args)
+        if not strategy.announce and strategy.fanout is not None:
+            raise ValueError(
+                "{!r} with a fanout doesn't reach every peer, use ('hybrid', {}) instead".format(
+                    name,
+                    strategy.fanout
+                )
+            )
+        return strategy
+
+    def push_targets(self, distributor, item):
+        """Neighbours to send an item to right away."""
+        return []
+
+
+class LazyPull(DisseminationStrategy):
+    """Only announce items and let neighbours request them."""
+
+
+class EagerPush(DisseminationStrategy):
+    """Send items to neighbours right away without announcing them."""
+
+    announce = False
+
+    def push_targets(self, distributor, item):
+        candidates = [
+            peer for peer in distributor.peer.peers
+            if item not in distributor.items_by_peer[peer]
+        ]
+        if self.fanout is None or len(candidates) <= self.fanout:
+            return candidates
+        # a stream per peer, so that draws don't depend on which peers share a process
+        random = rng.stream('dissemination/{}'.format(distributor.peer.node_id))
+        return random.sample(candidates, self.fanout)
+
+
+class Hybrid(EagerPush):
+    """Send items to some neighbours right away and announce them to the others."""
+
+    announce = True
+
+
+class Routed(DisseminationStrategy):
+    """Pass addressed items on along a shortest path towards their receiver only.
+
+    Peers on the way neither store nor announce the items, and the receiver doesn't pass them on.
+    """
+
+    announce = False
+    routed = True
+
+
+DISSEMINATION_STRATEGIES = {
+    'pull': LazyPull,
+    'push': EagerPush,
+    'hybrid': Hybrid,
+    'route': Routed,
+}
+
+
+class ItemSubscription(object):
+    """Interest of a process in newly fetched items of certain types for a certain block.
+
+    Matching items are collected as they arrive until they are taken with `next_items`. A block of
+    `None` matches items of any block.
+    """
+
+    def __init__(self, env, keys):
+        self.env = env
+        self.keys = keys  # [(type id, block), ...]
+        self.items = set()
+        self.event = None
+
+    def notify(self):
+        if self.event is not None and not self.event.triggered:
+            self.event.succeed()
+
+    def next_items(self):
+        """Wait until there are new matching items and return them."""
+        if not self.items:
+            self.event = self.env.event()
+            yield self.event
+            self.event = None
+        items = self.items
+        self.items = set()
+        return items
+
 
 class ItemDistributorService(Service):
 
@@ -350,92 +749,408 @@ class ItemDistributorService(Service):
         super().__init__(env, peer)
         self.known_items = set()  # items that at least one of our peers have
         self.fetched_items = set()  # items that we've already downloaded
-        self.items_by_peer = defaultdict(set)
-        self.next_fetch_event = self.env.event()
+        self.fetched_items_by_hash = {}
+        self.fetched_items_by_key = defaultdict(set)  # {(type id, block): items}
+        self.items_by_peer = defaultdict(set)  # items we know a peer has
+        self.subscriptions_by_key = defaultdict(set)
+
+        # fetched items in the order in which they have been fetched and, for each peer, the
+        # position in this log up to which they have been announced to it
+        self.fetched_log = []
+        self.announce_cursors = defaultdict(int)
+        # items a peer has announced that we haven't fetched yet (possibly outdated)
+        self.missing_items_by_peer = defaultdict(set)
+
+        # {item hash: (peer the item has been requested from, time at which we give up waiting)}
+        self.requests_in_flight = {}
+        self.duplicate_download_bytes = 0  # bytes of items received although already fetched
+
+        self.announce_interval = config.ANNOUNCE_INTERVAL
+        self.request_timeout = config.REQUEST_TIMEOUT
+        self.default_strategy = LazyPull()
+        # addressed items are routed to their receiver unless configured otherwise
+        self.strategies = {
+            item_type.type_id: Routed()
+            for item_type in ITEM_TYPES.values() if issubclass(item_type, AddressedItem)
+        }
+        for type_name, spec in config.DISSEMINATION_STRATEGIES.items():
+            item_type = ITEM_TYPES[type_name]
+            strategy = DisseminationStrategy.from_config(spec)
+            if strategy.routed and not issubclass(item_type, AddressedItem):
+                raise ValueError('{} items have no receiver to route them to'.format(type_name))
+            self.strategies[item_type.type_id] = strategy
+        self.routed_type_ids = set(
+            type_id for type_id, strategy in self.strategies.items() if strategy.routed
+        )
+        self.routes = Routes.for_env(env)
+        self.routes.add_peer(peer)
+        self.new_items_event = None
+        self.announcement_event = None
+
+        self.retention_blocks = config.RETENTION_BLOCKS
+        self.finality_votes = finality_votes()
+        self.final_block = None  # latest block with a collation and enough votes
+        self.horizon = 0  # items for blocks before this one are ignored
+        self.message_logger = logs.get_logger(peer, self.__class__.__name__, logging.DEBUG)
+        self.propagation = PropagationTracker.for_env(env)
+        self.propagation.add_peer()
 
     def handle_message(self, message, sender):
-        logger = self.logger.bind(time=self.env.now, **{'from': sender})
         if isinstance(message, AnnounceItems):
             # take note of new available items
-            items = set(message.items)
+            items = set(item for item in message.items if item.block >= self.horizon)
             self.items_by_peer[sender] |= items
-            n_new = len(items - self.known_items)
-            # logger.info('receiving announcement', total=len(items), new=n_new)
+            missing_items = items - self.fetched_items
+            if missing_items:
+                self.missing_items_by_peer[sender] |= missing_items
+                if self.announcement_event is not None:
+                    self.announcement_event.succeed()
+                    self.announcement_event = None
+            if self.message_logger:
+                self.message_logger.debug(
+                    'receiving announcement',
+                    total=len(items),
+                    new=len(items - self.known_items),
+                    time=self.env.now,
+                    **{'from': sender}
+                )
             self.known_items |= items
         if isinstance(message, SendItems):
+            received_items = message.items
+            if self.routed_type_ids:
+                # pass on routed items for other peers without keeping them
+                passing_items = [
+                    item for item in received_items
+                    if item.type_id in self.routed_type_ids and item.receiver != self.peer.address
+                ]
+                if passing_items:
+                    self.route([item for item in passing_items if item.block >= self.horizon])
+                    passing_items = set(passing_items)
+                    received_items = [
+                        item for item in received_items if item not in passing_items
+                    ]
             # take note of newly fetched items
-            items = set(message.items)
-            n_new = len(items - self.fetched_items)
-            # logger.info('receiving items', total=len(items), new=n_new)
+            items = set(item for item in received_items if item.block >= self.horizon)
+            new_items = items - self.fetched_items
+            self.duplicate_download_bytes += sum(
+                item.size for item in received_items if item in self.fetched_items
+            )
+            if self.message_logger:
+                self.message_logger.debug(
+                    'receiving items',
+                    total=len(items),
+                    new=len(new_items),
+                    time=self.env.now,
+                    **{'from': sender}
+                )
             self.items_by_peer[sender] |= items
             self.known_items |= items
-            self.fetched_items |= items
-            if n_new > 0:
-                self.next_fetch_event.succeed()
-                self.next_fetch_event = self.env.event()
+            self.add_fetched_items(new_items)
         if isinstance(message, RequestItems):
             # answer request as well as possible
             items = set()
             for hash_ in message.hashes:
-                for item in self.fetched_items:
-                    if hash(item) == hash_:
-                        items.add(item)
-            # logger.info('receiving request', total=len(message.hashes), known=len(items))
+                item = self.fetched_items_by_hash.get(hash_)
+                if item is not None:
+                    items.add(item)
+            if self.message_logger:
+                self.message_logger.debug(
+                    'receiving request',
+                    total=len(message.hashes),
+                    known=len(items),
+                    time=self.env.now,
+                    **{'from': sender}
+                )
             reply = SendItems(items)
             self.env.process(self.peer.send(reply, sender))
 
-    def get_items(self, type_ids, block, exclude=None):
-        exclude = exclude or set()
-        items = set()
-        fetched_once = False
+    def add_fetched_items(self, items):
+        """Store newly fetched items, pass them on and notify the processes waiting for them."""
+        notified_subscriptions = set()
+        finality_candidates = set()
+        pushed_items_by_peer = defaultdict(list)
+        n_announced = 0
+        for item in items:
+            if item.type_id in (Collation.type_id, Vote.type_id):
+                finality_candidates.add(item.block)
+            self.fetched_items.add(item)
+            self.fetched_items_by_hash[hash(item)] = item
+            self.requests_in_flight.pop(hash(item), None)
+            self.propagation.fetched(item, self.peer)
+
+            strategy = self.strategies.get(item.type_id, self.default_strategy)
+            if strategy.announce:
+                self.fetched_log.append(item)
+                n_announced += 1
+            for peer in strategy.push_targets(self, item):
+                pushed_items_by_peer[peer].append(item)
+                self.items_by_peer[peer].add(item)
+
+            key = (item.type_id, item.block)
+            self.fetched_items_by_key[key].add(item)
+            for subscription_key in (key, (item.type_id, None)):
+                for subscription in self.subscriptions_by_key.get(subscription_key, ()):
+                    subscription.items.add(item)
+                    notified_subscriptions.add(subscription)
+        for subscription in notified_subscriptions:
+            subscription.notify()
+        if n_announced and self.new_items_event is not None:
+            self.new_items_event.succeed()
+            self.new_items_event = None
+        if pushed_items_by_peer:
+            self.push(pushed_items_by_peer)
+        if self.retention_blocks is not None:
+            for block in sorted(finality_candidates):
+                self.check_finality(block)
+
+    def push(self, items_by_peer):
+        """Send items to peers without waiting for them to be requested."""
+        receivers_by_items = defaultdict(list)
+        for peer, items in items_by_peer.items():
+            receivers_by_items[tuple(items)].append(peer)
+        for items, receivers in receivers_by_items.items():
+            message = SendItems(items)
+            self.env.process(self.peer.broadcast(message, receivers))
+
+    def route(self, items):
+        """Send addressed items to the next hop towards their receivers.
+
+        Items whose receiver can't be reached from here are dropped.
+        """
+        items_by_peer = defaultdict(list)
+        for item in items:
+            next_hop = self.routes.next_hop(self.peer, item.receiver)
+            if next_hop is not None:
+                items_by_peer[next_hop].append(item)
+        if items_by_peer:
+            self.push(items_by_peer)
+
+    def check_finality(self, block):
+        """Check if a block has become final and if so forget about old blocks."""
+        if self.final_block is not None and block <= self.final_block:
+            return
+        if not self.fetched_items_by_key.get((Collation.type_id, block)):
+            return
+        if len(self.fetched_items_by_key.get((Vote.type_id, block), ())) < self.finality_votes:
+            return
+        self.final_block = block
+        horizon = block - self.retention_blocks + 1
+        if horizon > self.horizon:
+            for service in self.peer.services:
+                service.forget_blocks_before(horizon)
+
+    def forget_blocks_before(self, block):
+        """Drop all items for blocks before a certain one and stop distributing them."""
+        self.horizon = block
+        forgotten_items = set()
+        for key in [key for key in self.fetched_items_by_key if key[1] < block]:
+            forgotten_items |= self.fetched_items_by_key.pop(key)
+        self.fetched_items -= forgotten_items
+        for item in forgotten_items:
+            del self.fetched_items_by_hash[hash(item)]
+        self.known_items = set(item for item in self.known_items if item.block >= block)
+        for peer, items in self.items_by_peer.items():
+            self.items_by_peer[peer] = set(item for item in items if item.block >= block)
+        for peer, items in self.missing_items_by_peer.items():
+            self.missing_items_by_peer[peer] = set(item for item in items if item.block >= block)
+
+        # compact the log and move the cursors accordingly
+        fetched_log = []
+        n_kept_before = []
+        for item in self.fetched_log:
+            n_kept_before.append(len(fetched_log))
+            if item.block >= block:
+                fetched_log.append(item)
+        n_kept_before.append(len(fetched_log))
+        self.fetched_log = fetched_log
+        for peer, cursor in self.announce_cursors.items():
+            self.announce_cursors[peer] = n_kept_before[cursor]
+
+    def subscribe(self, type_ids, block):
+        """Start collecting newly fetched items of certain types for a block."""
         if not isinstance(type_ids, Container):
             type_ids = [type_ids]
-        while not items:
-            # check in items we've already fetched
-            for item in self.fetched_items:
-                if item.type_id not in type_ids:
-                    continue
-                if block is not None and item.block != block:
-                    continue
-                if item in exclude:
-                    continue
-                items.add(item)
+        subscription = ItemSubscription(self.env, [(type_id, block) for type_id in type_ids])
+        for key in subscription.keys:
+            self.subscriptions_by_key[key].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        for key in subscription.keys:
+            subscriptions = self.subscriptions_by_key[key]
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.subscriptions_by_key[key]
+
+    def find_items(self, type_ids, block, exclude):
+        """Get the already fetched items of certain types for a block."""
+        items = set()
+        for type_id in type_ids:
+            if block is None:
+                for (item_type_id, _), block_items in self.fetched_items_by_key.items():
+                    if item_type_id == type_id:
+                        items |= block_items
+            else:
+                items |= self.fetched_items_by_key.get((type_id, block), set())
+        return items - exclude
 
-            if fetched_once:
-                break
+    def get_items(self, type_ids, block, exclude=None):
+        """Get fetched items of certain types for a block that are not excluded.
 
+        If there are none yet, wait until at least one matching item arrives and return only the
+        newly arrived ones.
+        """
+        exclude = exclude or set()
+        if not isinstance(type_ids, Container):
+            type_ids = [type_ids]
+        items = self.find_items(type_ids, block, exclude)
+        if not items:
             # nothing matched, wait until new ones are sent by peers
-            if not items:
-                yield self.next_fetch_event
-            fetched_once = True
+            subscription = self.subscribe(type_ids, block)
+            new_items = yield from subscription.next_items()
+            self.unsubscribe(subscription)
+            items = new_items - exclude
         return items
 
     def distribute(self, item):
         """Add an item to the local distribution set and start announcing it to the network."""
+        if self.peer.tracer is not None:
+            self.peer.tracer.record_item(item, self.peer)
+        if item.type_id in self.routed_type_ids and item.receiver != self.peer.address:
+            self.propagation.created(item, self.peer, receivers=1)
+            self.route([item])
+            return
         self.known_items.add(item)
-        self.fetched_items.add(item)
-
-    def announce_request_loop(self, peer):
+        if item not in self.fetched_items:
+            self.propagation.created(item, self.peer)
+            self.add_fetched_items([item])
+
+    def wait_for_new_items(self):
+        """Get an event that succeeds once the next item has been fetched."""
+        if self.new_items_event is None:
+            self.new_items_event = self.env.event()
+        return self.new_items_event
+
+    def wait_for_announcement(self):
+        """Get an event that succeeds once a peer has announced items we haven't fetched yet."""
+        if self.announcement_event is None:
+            self.announcement_event = self.env.event()
+        return self.announcement_event
+
+    def announce_loop(self):
+        """Announce fetched items to all peers that don't have them yet.
+
+        Only the items fetched since the last announcement to a peer are considered. Peers that miss
+        exactly the same items share a single broadcast announcement. The loop sleeps until new
+        items have been fetched or the connection to a peer waiting for an announcement is idle
+        again, but announces at most once per announce interval.
+        """
         while True:
-            # announce
-            items = self.items_by_peer[peer]
-            new_items = self.fetched_items - items
-            if new_items and not self.peer.is_connection_busy(peer):
+            receivers_by_items = defaultdict(list)
+            busy_peers = []
+            for peer in self.peer.peers:
+                cursor = self.announce_cursors[peer]
+                if cursor == len(self.fetched_log):
+                    continue
+                if self.peer.is_connection_busy(peer):
+                    busy_peers.append(peer)
+                    continue
+                peer_items = self.items_by_peer[peer]
+                new_items = frozenset(
+                    item for item in self.fetched_log[cursor:] if item not in peer_items
+                )
+                self.announce_cursors[peer] = len(self.fetched_log)
+                if new_items:
+                    receivers_by_items[new_items].append(peer)
+            for new_items, receivers in receivers_by_items.items():
+                for peer in receivers:
+                    self.items_by_peer[peer] |= new_items
                 message = AnnounceItems(new_items)
-                yield self.env.process(self.peer.send(message, peer))
-                self.items_by_peer[peer] |= new_items
-            # request
-            items = self.items_by_peer[peer]
-            new_items = items - self.fetched_items
-            if new_items and not self.peer.is_connection_busy(peer):
-                message = RequestItems([hash(item) for item in new_items])
-                yield self.env.process(self.peer.send(message, peer))
-            # sleep
-            yield self.env.timeout(1)
+                self.env.process(self.peer.broadcast(message, receivers))
+
+            if receivers_by_items:
+                yield self.env.timeout(self.announce_interval)
+            else:
+                wake_up_events = [self.wait_for_new_items()]
+                wake_up_events.extend(self.peer.wait_until_idle(peer) for peer in busy_peers)
+                yield self.env.any_of(wake_up_events)
+
+    def request_loop(self):
+        """Request items peers have announced, but that we haven't fetched yet.
+
+        Each item is only requested from one peer at a time, the one from which it is expected to
+        arrive first. If it doesn't arrive in time, it is requested again. The loop sleeps until a
+        peer announces items we are missing, the connection to a peer that has missing items is
+        idle again or a request times out, but requests at most once per announce interval.
+        """
+        while True:
+            now = self.env.now
+            self.requests_in_flight = {
+                hash_: (source, deadline)
+                for hash_, (source, deadline) in self.requests_in_flight.items()
+                if deadline > now
+            }
+
+            candidates_by_item = defaultdict(list)
+            busy_peers = []
+            for peer, missing_items in self.missing_items_by_peer.items():
+                missing_items = set(
+                    item for item in missing_items if item not in self.fetched_items
+                )
+                self.missing_items_by_peer[peer] = missing_items
+                requestable_items = [
+                    item for item in missing_items if hash(item) not in self.requests_in_flight
+                ]
+                if not requestable_items:
+                    continue
+                if self.peer.is_connection_busy(peer):
+                    busy_peers.append(peer)
+                    continue
+                for item in requestable_items:
+                    candidates_by_item[item].append(peer)
+
+            items_by_source = self.choose_sources(candidates_by_item)
+            for source, items in items_by_source.items():
+                for item in items:
+                    self.requests_in_flight[hash(item)] = (source, now + self.request_timeout)
+                message = RequestItems([hash(item) for item in items])
+                self.env.process(self.peer.send(message, source))
+
+            if items_by_source:
+                yield self.env.timeout(self.announce_interval)
+            else:
+                wake_up_events = [self.wait_for_announcement()]
+                wake_up_events.extend(self.peer.wait_until_idle(peer) for peer in busy_peers)
+                if self.requests_in_flight:
+                    next_deadline = min(
+                        deadline for _, deadline in self.requests_in_flight.values()
+                    )
+                    wake_up_events.append(self.env.timeout(next_deadline - now))
+                yield self.env.any_of(wake_up_events)
+
+    def choose_sources(self, candidates_by_item):
+        """Choose the peer to request each item from.
+
+        Items are assigned one after another to the candidate from which they are expected to
+        arrive first, taking into account the items already assigned to it.
+        """
+        items_by_source = defaultdict(list)
+        requested_bytes = defaultdict(int)
+        for item, candidates in candidates_by_item.items():
+            if len(candidates) == 1:
+                source = candidates[0]
+            else:
+                source = min(candidates, key=lambda peer: self.peer.estimate_download_time(
+                    requested_bytes[peer] + item.size,
+                    peer
+                ))
+            items_by_source[source].append(item)
+            requested_bytes[source] += item.size
+        return items_by_source
 
     def start(self):
-        processes = []
-        for peer in self.peer.peers:
-            process = self.env.process(self.announce_request_loop(peer))
-            processes.append(process)
+        processes = [
+            self.env.process(self.announce_loop()),
+            self.env.process(self.request_loop()),
+        ]
         yield self.env.all_of(processes)
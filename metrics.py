@@ -0,0 +1,137 @@
+"""Cheap recording of protocol events and the per-block phase durations derived from them.
+
+Services record an event as a code together with the block and the number of the peer it
+happened at. The records go into typed arrays, so that recording costs a few appends instead
+of the formatting and dispatching a log call does. The phases of each block are only
+reconstructed from them when asked for at the end of a run.
+"""
+from array import array
+from collections import defaultdict
+from itertools import count
+import math
+from weakref import WeakKeyDictionary
+
+
+event_codes = count()
+KEYPER_STARTED = next(event_codes)
+SECRETS_COLLECTED = next(event_codes)
+NONCES_COLLECTED = next(event_codes)  # also the time the keyper sends its enc key share
+ENC_KEY_RECEIVED = next(event_codes)  # a user has enough enc key shares for a block
+COLLATION_CREATED = next(event_codes)
+COLLATION_RECEIVED = next(event_codes)  # by a validator
+DEC_KEY_RECEIVED = next(event_codes)  # a validator has enough dec key shares for a block
+VOTED = next(event_codes)
+
+# (name, start event, end event, whether start and end have to happen at the same peer)
+# If not, a phase starts when the start event happens for the first time for that block.
+PHASES = [
+    ('secrets', KEYPER_STARTED, SECRETS_COLLECTED, True),
+    ('nonces', SECRETS_COLLECTED, NONCES_COLLECTED, True),
+    ('enc_key', NONCES_COLLECTED, ENC_KEY_RECEIVED, False),
+    ('collation', COLLATION_CREATED, COLLATION_RECEIVED, False),
+    ('dec_key', COLLATION_RECEIVED, DEC_KEY_RECEIVED, True),
+]
+# the vote quorum phase lasts from the first vote until enough votes for finality have been cast
+QUORUM_PHASE = 'vote_quorum'
+
+
+def percentile(sorted_values, p):
+    """Percentile of a sorted list of values, interpolating linearly between closest ranks."""
+    if not sorted_values:
+        return math.nan
+    position = (len(sorted_values) - 1) * p / 100
+    lower = math.floor(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+class Metrics(object):
+    """Event records of one simulation run."""
+
+    collectors = WeakKeyDictionary()
+
+    def __init__(self, env):
+        self.env = env
+        self.times = array('d')
+        self.events = array('b')
+        self.blocks = array('l')
+        self.peers = array('l')
+
+    @classmethod
+    def for_env(cls, env):
+        """Get the metrics collector shared by all peers in a simulation environment."""
+        if env not in cls.collectors:
+            cls.collectors[env] = cls(env)
+        return cls.collectors[env]
+
+    def __len__(self):
+        return len(self.times)
+
+    def record(self, event, block, peer):
+        """Take note that an event has happened for a block at a peer (given by its number)."""
+        self.times.append(self.env.now)
+        self.events.append(event)
+        self.blocks.append(block)
+        self.peers.append(peer)
+
+    def event_times(self):
+        """Times of all recorded events, as {event: {block: {peer: time}}}.
+
+        If an event is recorded several times for the same peer and block, the first time counts.
+        """
+        times = defaultdict(lambda: defaultdict(dict))
+        for time, event, block, peer in zip(self.times, self.events, self.blocks, self.peers):
+            times[event][block].setdefault(peer, time)
+        return times
+
+    def phase_durations(self, quorum):
+        """Durations of all completed phases, as {phase: {block: sorted list of durations}}.
+
+        `quorum` is the number of votes after which the vote quorum phase ends.
+        """
+        times = self.event_times()
+        durations = defaultdict(dict)
+        for name, start_event, end_event, same_peer in PHASES:
+            for block, end_times in times[end_event].items():
+                start_times = times[start_event].get(block)
+                if not start_times:
+                    continue
+                if same_peer:
+                    phase_durations = [
+                        end_time - start_times[peer]
+                        for peer, end_time in end_times.items()
+                        if peer in start_times
+                    ]
+                else:
+                    start_time = min(start_times.values())
+                    phase_durations = [end_time - start_time for end_time in end_times.values()]
+                if phase_durations:
+                    durations[name][block] = sorted(phase_durations)
+        for block, vote_times in times[VOTED].items():
+            if len(vote_times) >= quorum:
+                vote_times = sorted(vote_times.values())
+                durations[QUORUM_PHASE][block] = [vote_times[quorum - 1] - vote_times[0]]
+        return durations
+
+    def phase_percentiles(self, quorum, percentiles=(50, 90, 100)):
+        """Percentiles of the phase durations across peers, as {phase: {block: [percentiles]}}."""
+        return {
+            phase: {
+                block: [percentile(block_durations, p) for p in percentiles]
+                for block, block_durations in sorted(durations_by_block.items())
+            }
+            for phase, durations_by_block in self.phase_durations(quorum).items()
+        }
+
+    def format_phases(self, quorum, percentiles=(50, 90, 100)):
+        """Table of the phase duration percentiles of each block."""
+        lines = []
+        phase_percentiles = self.phase_percentiles(quorum, percentiles)
+        for phase in [name for name, *_ in PHASES] + [QUORUM_PHASE]:
+            lines.append('{} (p{})'.format(phase, '/p'.join(str(p) for p in percentiles)))
+            for block, values in phase_percentiles.get(phase, {}).items():
+                lines.append('{:>10}: {}'.format(
+                    block,
+                    ' '.join('{:8.2f}'.format(value) for value in values)
+                ))
+        return '\n'.join(lines)
@@ -1,5 +1,5 @@
-import random
 import config
+import topology
 from user import User
 from collator import Collator
 from validator import Validator
@@ -26,10 +26,7 @@ def full_network(env):
     ]
     network = users + [collator] + keypers + validators
 
-    # for now just randomly connect everyone with everyone
-    for peer in network:
-        while len(peer.peers) < config.N_USER_CONNECTIONS:
-            other = random.choice(network)
-            peer.connect(other)
+    for i, j in topology.network_edges(len(users), len(keypers), len(validators)):
+        network[i].connect(network[j])
 
     return users, collator, keypers, validators
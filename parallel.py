@@ -0,0 +1,242 @@
+"""Conservative parallel simulation of a network split into partitions.
+
+With `config.PARTITIONS` > 1, peer `i` of `networks.full_network` is simulated by partition
+`i % PARTITIONS` and every partition runs in its own process and simpy environment. Each process
+builds the whole network, so that peers keep their numbers and connections, but only starts the
+peers of its partition. The others only stand in for their counterparts in other processes.
+
+Partitioned runs need the store and forward connection model (`config.CONNECTION_MODEL`): a
+message first goes over the uplink of the sender and, after the latency, over the downlink of
+the receiver. Messages to peers of other partitions are handed over with a timestamp once they
+have left the uplink. This gives every partition a lookahead: a message sent at time `t` is
+handed over at `t + latency + base_size / uplink` at the earliest. A coordinator lets the
+partitions advance in windows that end at the earliest time any of them could hand over a
+message, i.e. at the minimum over all partitions of their next event plus their lookahead, so
+that no partition ever receives a message from its past.
+
+Runs are deterministic and give the same results as an unpartitioned run with the same model,
+no matter the number of partitions. To that end, messages reach the downlinks in the same order
+in both (see `main.Handovers`), peers only know about the messages on their own end of a
+connection, and random draws come from streams that are never shared by peers of different
+partitions. A window only includes the events before its end, those at its end follow in the
+next one, after the messages handed over for that time.
+
+Without latency, the lookahead is tiny (15 us for the uplink of the collator) and partitions
+spend most of their time synchronising. Partitioned runs only pay off with a `config.LATENCY`
+in the order of milliseconds and many peers per partition. Only the 'reservation' bandwidth
+model is supported. Partitions don't log, trace files get the partition number as suffix, and
+propagation tracking isn't available, since each partition only sees part of the arrivals.
+"""
+from copy import copy
+import math
+import multiprocessing
+import time
+
+import simpy
+
+import config
+import logs
+import rng
+
+
+class Partition(object):
+    """The peers of a network that are simulated in this process."""
+
+    def __init__(self, env, index, n_partitions, network):
+        from main import Handovers, Message
+
+        self.env = env
+        self.network = network
+        self.handovers = Handovers.for_env(env)
+        self.indices = {peer: i for i, peer in enumerate(network)}
+        self.peers = network[index::n_partitions]
+        for peer in self.peers:
+            peer.partition = self
+        # (time, sender index, sequence, receiver index, message) of messages for other partitions
+        self.outbox = []
+        # one object per item hash, so that items arriving as copies from other partitions are
+        # the very objects peers here already have, which keeps set operations on them fast
+        self.items = {}
+        self.horizon = 0  # items of blocks before this one have been forgotten by all peers
+
+        boundary_peers = [
+            peer for peer in self.peers
+            if any(neighbour.partition is not self for neighbour in peer.peers)
+        ]
+        # minimum time between sending a message and handing it over
+        self.lookahead = min(
+            (Message.base_size / peer.max_uplink + peer.latency for peer in boundary_peers),
+            default=math.inf
+        )
+
+    def start(self):
+        for peer in self.peers:
+            peer.start()
+
+    def next_time(self):
+        """Time of the next scheduled event (infinity if there is none)."""
+        return self.env.peek()
+
+    def hand_over(self, time, sequence, message, sender, receiver):
+        """Pass a message to another partition once it has left the uplink of the sender."""
+        if hasattr(message, 'items'):
+            # as a list, so the receiver gets the items in the order in which local receivers of
+            # the message see them, which unpickling a set wouldn't preserve
+            message = copy(message)
+            message.items = list(message.items)
+            for item in message.items:
+                self.items.setdefault(hash(item), item)
+        self.outbox.append(
+            (time, self.indices[sender], sequence, self.indices[receiver], message)
+        )
+
+    def intern(self, items):
+        """Replace items by the objects with the same hash that are already known here."""
+        return [self.items.setdefault(hash(item), item) for item in items]
+
+    def take_over(self, handovers):
+        """Schedule the messages handed over by other partitions."""
+        now = self.env.now
+        horizon = min(peer.distributor.horizon for peer in self.peers)
+        if horizon > self.horizon:
+            self.items = {
+                item_hash: item for item_hash, item in self.items.items() if item.block >= horizon
+            }
+            self.horizon = horizon
+        for handover_time, sender, sequence, receiver, message in handovers:
+            if handover_time < now:
+                raise RuntimeError('message handed over at {} arrived at {}'.format(
+                    handover_time,
+                    now
+                ))
+            if hasattr(message, 'items'):
+                message.items = self.intern(message.items)
+            self.handovers.add(
+                handover_time,
+                sequence,
+                message,
+                self.network[sender],
+                self.network[receiver]
+            )
+
+    def run(self, until, handovers):
+        """Simulate one window and return the time of the next event and the handovers."""
+        self.take_over(handovers)
+        # only the events before `until`, whereas `env.run(until)` would also process urgent ones
+        # at `until` that were scheduled before, e.g. handovers
+        while self.env.peek() < until:
+            self.env.step()
+        outbox, self.outbox = self.outbox, []
+        return self.next_time(), outbox
+
+
+def simulate_partition(connection, config_values, index, duration):
+    """Simulate one partition, window by window as the coordinator says (in a worker process)."""
+    for name, value in config_values.items():
+        setattr(config, name, value)
+    if config.TRACE_FILE is not None:
+        config.TRACE_FILE = '{}.{}'.format(config.TRACE_FILE, index)
+
+    # only now, as the simulation modules read parts of the config at import time
+    from metrics import Metrics
+    from networks import full_network
+    from tracing import Tracer
+    import sim
+
+    logs.silence()
+    rng.reset()
+    env = simpy.Environment()
+    users, collator, keypers, validators = full_network(env)
+    partition = Partition(env, index, config.PARTITIONS, users + [collator] + keypers + validators)
+    partition.start()
+    connection.send((partition.next_time(), partition.lookahead))
+
+    while True:
+        window = connection.recv()
+        if window is None:
+            break
+        connection.send(partition.run(*window))
+
+    if config.TRACE_FILE is not None:
+        Tracer.for_env(env, config.TRACE_FILE).close()
+    metrics = Metrics.for_env(env)
+    connection.send((
+        sim.peer_counters(partition.peers),
+        (metrics.times, metrics.events, metrics.blocks, metrics.peers)
+    ))
+
+
+def run(duration):
+    """Run the simulation described by `config` in `config.PARTITIONS` processes.
+
+    Returns a summary and the metrics of all partitions like `sim.run`. The summary additionally
+    contains the number of synchronisation windows.
+    """
+    from metrics import Metrics
+    import sim
+
+    if config.BANDWIDTH_MODEL != 'reservation':
+        raise ValueError('partitioned runs need the reservation bandwidth model')
+    if config.CONNECTION_MODEL != 'store_and_forward':
+        raise ValueError('partitioned runs need the store and forward connection model')
+    n_partitions = config.PARTITIONS
+    config_values = {name: value for name, value in vars(config).items() if name.isupper()}
+    context = multiprocessing.get_context('spawn')
+    connections = []
+    processes = []
+    try:
+        for index in range(n_partitions):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(
+                target=simulate_partition,
+                args=(worker_connection, config_values, index, duration)
+            )
+            process.start()
+            connections.append(connection)
+            processes.append(process)
+        next_times, lookaheads = zip(*(connection.recv() for connection in connections))
+
+        start_time = time.perf_counter()
+        inboxes = [[] for _ in range(n_partitions)]
+        n_windows = 0
+        until = 0
+        while until < duration:
+            # no partition can hand over a message before its next event plus its lookahead
+            until = min([duration] + [
+                min([next_time] + [handover[0] for handover in inbox]) + lookahead
+                for next_time, inbox, lookahead in zip(next_times, inboxes, lookaheads)
+            ])
+            for connection, inbox in zip(connections, inboxes):
+                connection.send((until, inbox))
+            inboxes = [[] for _ in range(n_partitions)]
+            next_times = []
+            for connection in connections:
+                next_time, outbox = connection.recv()
+                next_times.append(next_time)
+                for handover in outbox:
+                    inboxes[handover[3] % n_partitions].append(handover)
+            n_windows += 1
+        wall_time = time.perf_counter() - start_time
+
+        for connection in connections:
+            connection.send(None)
+        counters = {}
+        metrics = Metrics(None)
+        for connection in connections:
+            partition_counters, (times, events, blocks, peers) = connection.recv()
+            for name, values in partition_counters.items():
+                counters.setdefault(name, []).extend(values)
+            metrics.times.extend(times)
+            metrics.events.extend(events)
+            metrics.blocks.extend(blocks)
+            metrics.peers.extend(peers)
+    except BaseException:
+        for process in processes:
+            process.terminate()
+        raise
+    for process in processes:
+        process.join()
+
+    summary = sim.summarize(duration, wall_time, counters, metrics)
+    summary['windows'] = n_windows
+    return summary, metrics
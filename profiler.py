@@ -0,0 +1,108 @@
+"""Accounting of processed events and the wall time spent on them, by the code they resume.
+
+`ProfilingEnvironment` can be used in place of `simpy.Environment`. For each event it processes,
+it looks at the first callback of the event, which usually resumes a waiting process, and
+charges the event and the wall time its callbacks take to that callback's origin. The origin is
+given by the class of the peer, the class of the object the code belongs to (a service or the
+peer itself), and the function name. For example, `('Keyper', 'ItemDistributorService',
+'ItemDistributorService.request_loop')`. The time includes everything the callbacks call, so
+e.g. handling a message at the receiver is charged to the `Peer.send` of the sender.
+"""
+from collections import defaultdict
+import time
+
+import simpy
+from simpy.events import Condition, Process
+
+
+class ProfilingEnvironment(simpy.Environment):
+    """Simulation environment that keeps track of what its events cost."""
+
+    def __init__(self, *args, sample_interval=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.event_counts = defaultdict(int)
+        self.wall_times = defaultdict(float)
+        self.sample_interval = sample_interval  # simulated time between queue length samples
+        self.queue_lengths = []  # (simulated time, number of scheduled events)
+        self.next_sample_time = 0
+
+    def step(self):
+        if not self._queue:
+            return super().step()
+        event = self._queue[0][3]
+        if event.callbacks:
+            origin = callback_origin(event.callbacks[0])
+        else:
+            origin = ('', '', 'no callbacks')
+        if self._queue[0][0] >= self.next_sample_time:
+            self.queue_lengths.append((self._queue[0][0], len(self._queue)))
+            self.next_sample_time = self._queue[0][0] + self.sample_interval
+
+        start_time = time.perf_counter()
+        try:
+            super().step()
+        finally:
+            self.wall_times[origin] += time.perf_counter() - start_time
+            self.event_counts[origin] += 1
+
+    def report(self, top=20):
+        """Summary of the most expensive origins and the length of the event queue over time."""
+        total_events = sum(self.event_counts.values())
+        total_time = sum(self.wall_times.values())
+        simulated_time = self.now or 1
+        lines = [
+            '{} events in {:.2f} s, {:.0f} events per simulated second, {:.0f} events per second'
+            .format(
+                total_events,
+                total_time,
+                total_events / simulated_time,
+                total_events / total_time if total_time else 0
+            ),
+            '{:>8} {:>7} {:>10} {:>10}  {}'.format(
+                'time', 'share', 'events/s', 'us/event', 'peer / owner / function'
+            ),
+        ]
+        origins = sorted(self.wall_times, key=self.wall_times.get, reverse=True)
+        for origin in origins[:top]:
+            wall_time = self.wall_times[origin]
+            n_events = self.event_counts[origin]
+            lines.append('{:>8.2f} {:>7.1%} {:>10.1f} {:>10.1f}  {}'.format(
+                wall_time,
+                wall_time / total_time if total_time else 0,
+                n_events / simulated_time,
+                wall_time / n_events * 1e6,
+                ' / '.join(part for part in origin if part)
+            ))
+
+        if self.queue_lengths:
+            lengths = [length for _, length in self.queue_lengths]
+            lines.append('scheduled events: min {}, mean {:.0f}, max {}'.format(
+                min(lengths),
+                sum(lengths) / len(lengths),
+                max(lengths)
+            ))
+            step = max(1, len(self.queue_lengths) // 10)
+            for sample_time, length in self.queue_lengths[::step]:
+                lines.append('{:>10.1f} s: {:>8}'.format(sample_time, length))
+        return '\n'.join(lines)
+
+
+def callback_origin(callback):
+    """(peer class, owner class, function name) of the code an event callback runs."""
+    if isinstance(getattr(callback, '__self__', None), Process):
+        generator = callback.__self__._generator
+        function_name = generator.__qualname__
+        owner = generator.gi_frame.f_locals.get('self') if generator.gi_frame else None
+    elif isinstance(getattr(callback, '__self__', None), Condition):
+        return ('', '', 'Condition')
+    elif hasattr(callback, 'func'):  # functools.partial
+        function_name = callback.func.__qualname__
+        owner = getattr(callback.func, '__self__', None)
+    else:
+        function_name = getattr(callback, '__qualname__', repr(callback))
+        owner = getattr(callback, '__self__', None)
+
+    if owner is None:
+        return ('', '', function_name)
+    peer = getattr(owner, 'peer', owner)
+    return (peer.__class__.__name__, owner.__class__.__name__, function_name)
@@ -0,0 +1,208 @@
+"""Online tracking of how fast items spread through the network.
+
+`PropagationTracker` is told when an item is created and when a peer fetches an item for the
+first time. It aggregates the delays into `LogHistogram`s right away instead of storing every
+arrival, so its memory only depends on the number of items that are still spreading, not on the
+length of a run. For each item type it keeps
+
+- the delay until the item arrives at a peer, by the kind of peer (e.g. transactions arriving at
+  the collator),
+- the delay until the item has reached a certain fraction of all peers (its coverage), and
+- how many items reached each fraction at all.
+
+Items routed to a single receiver (see `routing`) only count the receiver instead of all peers.
+Items that haven't reached all peers `config.PROPAGATION_WINDOW` seconds after their creation
+stop being tracked and count as not having reached the remaining fractions.
+"""
+from collections import defaultdict, OrderedDict
+import math
+from weakref import WeakKeyDictionary
+
+import config
+
+
+class LogHistogram(object):
+    """Histogram of non-negative values in buckets whose bounds grow geometrically.
+
+    Quantiles are accurate up to `relative_error` for values above `min_value`; smaller values
+    all go into the first bucket. The number of buckets grows with the logarithm of the range of
+    the values only, and histograms with the same parameters can be merged by adding up counts.
+    """
+
+    def __init__(self, relative_error=0.01, min_value=1e-6):
+        self.relative_error = relative_error
+        self.min_value = min_value
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self.log_gamma = math.log(self.gamma)
+        self.counts = defaultdict(int)  # {bucket index: number of values}
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def __len__(self):
+        return self.count
+
+    def bucket(self, value):
+        """Index of the bucket covering `(min_value * gamma**(i - 1), min_value * gamma**i]`."""
+        if value <= self.min_value:
+            return 0
+        return math.ceil(math.log(value / self.min_value) / self.log_gamma)
+
+    def add(self, value, count=1):
+        self.counts[self.bucket(value)] += count
+        self.count += count
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add the values of another histogram with the same parameters to this one."""
+        if (other.relative_error, other.min_value) != (self.relative_error, self.min_value):
+            raise ValueError('cannot merge histograms with different buckets')
+        for index, count in other.counts.items():
+            self.counts[index] += count
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """Estimate of the `q`-quantile (between 0 and 1) of the values."""
+        if not self.count:
+            return math.nan
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen > rank:
+                break
+        estimate = self.min_value * 2 * self.gamma**index / (self.gamma + 1)
+        return min(max(estimate, self.min), self.max)
+
+    def percentile(self, p):
+        return self.quantile(p / 100)
+
+    def count_up_to(self, value):
+        """Number of values up to a bound (rounded to the bucket boundaries)."""
+        index = self.bucket(value)
+        return sum(count for i, count in self.counts.items() if i <= index)
+
+
+class PropagationTracker(object):
+    """Propagation delays of all items distributed in a simulation environment."""
+
+    trackers = WeakKeyDictionary()
+
+    def __init__(self, env, fractions=(0.5, 0.9, 1.0)):
+        self.env = env
+        self.fractions = fractions
+        self.window = config.PROPAGATION_WINDOW
+        self.n_peers = 0
+
+        # items that are still spreading, in the order of creation, as {item hash: [creation
+        # time, number of peers that have it, number of peers it is for, item class, creator]}
+        self.open_items = OrderedDict()
+        self.arrival_delays = defaultdict(LogHistogram)  # {(item class, peer class): histogram}
+        self.coverage_delays = defaultdict(LogHistogram)  # {(item class, fraction): histogram}
+        self.n_created = defaultdict(int)  # {item class: number of items}
+        # {item class: number of (item, peer other than the creator) pairs the items are for}
+        self.n_receivers = defaultdict(int)
+        self.n_closed = defaultdict(int)  # {item class: number of items not tracked anymore}
+
+    @classmethod
+    def for_env(cls, env):
+        """Get the tracker shared by all peers in a simulation environment."""
+        if env not in cls.trackers:
+            cls.trackers[env] = cls(env)
+        return cls.trackers[env]
+
+    def add_peer(self):
+        """Count a peer towards the total the coverage of items refers to."""
+        self.n_peers += 1
+
+    def created(self, item, peer, receivers=None):
+        """Start tracking an item created by a peer (before the peer fetches it itself).
+
+        `receivers` is the number of peers the item is for if the creator doesn't keep it itself,
+        by default it is for all peers including the creator.
+        """
+        now = self.env.now
+        while self.open_items:
+            state = next(iter(self.open_items.values()))
+            if state[0] > now - self.window:
+                break
+            self.open_items.popitem(last=False)
+            self.n_closed[state[3]] += 1
+        if hash(item) not in self.open_items:
+            n_targets = self.n_peers if receivers is None else receivers
+            self.open_items[hash(item)] = [now, 0, n_targets, item.__class__, peer]
+            self.n_created[item.__class__] += 1
+            self.n_receivers[item.__class__] += self.n_peers - 1 if receivers is None else receivers
+
+    def fetched(self, item, peer):
+        """Take note that a peer has got an item for the first time."""
+        state = self.open_items.get(hash(item))
+        if state is None:
+            return  # not created in this environment or not tracked anymore
+        creation_time, n_reached, n_targets, item_class, creator = state
+        delay = self.env.now - creation_time
+        if peer is not creator:
+            self.arrival_delays[item_class, peer.__class__].add(delay)
+        n_reached += 1
+        state[1] = n_reached
+        for fraction in self.fractions:
+            if n_reached == math.ceil(fraction * n_targets):
+                self.coverage_delays[item_class, fraction].add(delay)
+        if n_reached >= n_targets:
+            del self.open_items[hash(item)]
+            self.n_closed[item_class] += 1
+
+    def arrival_histogram(self, item_class):
+        """Delays until items of a type arrive at a peer, for all kinds of peers."""
+        histogram = LogHistogram()
+        for (arrival_item_class, _), delays in self.arrival_delays.items():
+            if arrival_item_class is item_class:
+                histogram.merge(delays)
+        return histogram
+
+    def coverage(self, item_class, delay):
+        """Average fraction of the other peers items of a type are for that they reach in time."""
+        n_pairs = self.n_receivers[item_class]
+        if not n_pairs:
+            return math.nan
+        return self.arrival_histogram(item_class).count_up_to(delay) / n_pairs
+
+    def format(self, percentiles=(50, 90, 100), delays=(0.5, 1, 2, 5, 10, 20)):
+        """Tables of arrival and coverage delay percentiles and of the coverage over time."""
+        item_classes = sorted(self.n_created, key=lambda item_class: item_class.__name__)
+        header = '(p{})'.format('/p'.join(str(p) for p in percentiles))
+        lines = ['arrival delay by receiving peer {}'.format(header)]
+        for (item_class, peer_class), histogram in sorted(
+            self.arrival_delays.items(),
+            key=lambda entry: (entry[0][0].__name__, entry[0][1].__name__)
+        ):
+            lines.append('{:>30}: {}'.format(
+                '{} at {}'.format(item_class.__name__, peer_class.__name__),
+                ' '.join('{:8.2f}'.format(histogram.percentile(p)) for p in percentiles)
+            ))
+
+        lines.append('delay until reached by a fraction of all peers {}'.format(header))
+        for item_class in item_classes:
+            for fraction in self.fractions:
+                histogram = self.coverage_delays[item_class, fraction]
+                lines.append('{:>30}: {} ({} of {} items)'.format(
+                    '{} {:.0%}'.format(item_class.__name__, fraction),
+                    ' '.join('{:8.2f}'.format(histogram.percentile(p)) for p in percentiles),
+                    len(histogram),
+                    self.n_created[item_class]
+                ))
+
+        lines.append('fraction of other peers reached within {} s'.format(
+            '/'.join('{:g}'.format(delay) for delay in delays)
+        ))
+        for item_class in item_classes:
+            lines.append('{:>30}: {}'.format(
+                item_class.__name__,
+                ' '.join('{:8.1%}'.format(self.coverage(item_class, delay)) for delay in delays)
+            ))
+        return '\n'.join(lines)
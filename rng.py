@@ -0,0 +1,27 @@
+"""Named, independently seeded random number streams.
+
+Every source of randomness in the simulation draws from its own stream, e.g. `'topology'` or
+`'arrivals/3'` for the transaction arrivals of user 3. A stream is seeded from `config.SEED` and
+its name only, so it produces the same numbers no matter how many other streams exist or how
+much they are used. Two scenarios run with the same seed therefore share their random numbers
+wherever they overlap (common random numbers), which makes paired comparisons much less noisy.
+"""
+import random
+
+import config
+
+
+streams = {}
+
+
+def stream(name):
+    """Get the random number generator of a named stream, creating it on first use."""
+    if name not in streams:
+        # string seeds are hashed with SHA-512, so they don't depend on PYTHONHASHSEED
+        streams[name] = random.Random('{}/{}'.format(config.SEED, name))
+    return streams[name]
+
+
+def reset():
+    """Forget all streams so that they start over, e.g. after `config.SEED` has changed."""
+    streams.clear()
@@ -0,0 +1,63 @@
+"""Shortest-path routes towards peers with an address.
+
+Addressed items (e.g. secret shares) are only meant for a single peer, so instead of spreading
+them through the whole network, peers pass them on to the next hop on a shortest path towards
+their receiver, see `main.Routed`. Peers are reachable by their `address`, which only keypers
+have. The next hops towards an address are computed with a breadth-first search from the peer
+with that address the first time they are needed, i.e. once all connections have been made.
+Among several shortest paths, the one found first following the order of `Peer.peers` is taken,
+so routes are deterministic.
+"""
+from collections import deque
+from weakref import WeakKeyDictionary
+
+
+class Routes(object):
+    """Next hops towards the peers with an address, shared by all peers of an environment."""
+
+    routes = WeakKeyDictionary()
+
+    def __init__(self, env):
+        self.env = env
+        self.peers = []
+        self.peers_by_address = None  # built on first use, when all peers have been created
+        self.next_hops = {}  # {address: {peer: neighbour on a shortest path to the address}}
+
+    @classmethod
+    def for_env(cls, env):
+        """Get the routes shared by all peers in a simulation environment."""
+        if env not in cls.routes:
+            cls.routes[env] = cls(env)
+        return cls.routes[env]
+
+    def add_peer(self, peer):
+        self.peers.append(peer)
+
+    def next_hop(self, peer, address):
+        """The neighbour to pass an item for an address on to (`None` if it can't be reached).
+
+        For the peer with the address itself, this is the peer.
+        """
+        if address not in self.next_hops:
+            self.next_hops[address] = self.shortest_paths(address)
+        return self.next_hops[address].get(peer)
+
+    def shortest_paths(self, address):
+        """Next hops of all peers that can reach the peer with an address."""
+        if self.peers_by_address is None:
+            self.peers_by_address = {
+                peer.address: peer for peer in self.peers if peer.address is not None
+            }
+        receiver = self.peers_by_address.get(address)
+        if receiver is None:
+            return {}
+        # search from the receiver, so that every peer is found from its next hop
+        next_hops = {receiver: receiver}
+        queue = deque([receiver])
+        while queue:
+            peer = queue.popleft()
+            for neighbour in peer.peers:
+                if neighbour not in next_hops:
+                    next_hops[neighbour] = peer
+                    queue.append(neighbour)
+        return next_hops
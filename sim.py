@@ -1,48 +1,129 @@
+import argparse
+from itertools import chain
 import logging
-import sys
+import time
 
 import simpy
-import structlog
 
 import config
+from collator import Collator
+from keyper import Keyper
 from networks import full_network
-from main import ItemDistributorService
+from main import ItemDistributorService, finality_votes
+from metrics import Metrics, percentile
+from profiler import ProfilingEnvironment
+from propagation import PropagationTracker
+from tracing import Tracer
+from validator import Validator
+import logs
+import parallel
+import rng
 
 
-class LogFilter(object):
+def run(duration, env=None):
+    """Run the simulation described by `config`, in a new environment unless one is given.
 
-    def __init__(self, conditions=None):
-        self.conditions = conditions or {}
+    Returns a summary of the results and the metrics collected during the run.
 
-    def __call__(self, logger, method_name, event_dict):
-        for key, condition in self.conditions.items():
-            if key in event_dict and not condition(event_dict[key]):
-                raise structlog.DropEvent
-        return event_dict
+    The network is built from the current values in `config`, so they have to be set before this
+    module is imported (some of them are read at import time) and a process should only run one
+    simulation (peers are numbered globally).
+
+    With `config.PARTITIONS` > 1, the run is split across processes by `parallel.run`.
+    """
+    if config.PARTITIONS > 1:
+        if env is not None:
+            raise ValueError('partitioned runs create their own environments')
+        return parallel.run(duration)
+
+    rng.reset()
+    if env is None:
+        env = simpy.Environment()
+    users, collator, keypers, validators = full_network(env)
+    network = users + [collator] + keypers + validators
+    for peer in network:
+        peer.start()
+
+    start_time = time.perf_counter()
+    env.run(duration)
+    wall_time = time.perf_counter() - start_time
+    if config.TRACE_FILE is not None:
+        Tracer.for_env(env, config.TRACE_FILE).close()
+
+    metrics = Metrics.for_env(env)
+    return summarize(duration, wall_time, peer_counters(network), metrics), metrics
+
+
+def peer_counters(peers):
+    """The state of peers a summary is computed from, as {name: [value of each peer]}."""
+    return {
+        'validator_blocks': [
+            peer.validator_service.current_block for peer in peers if isinstance(peer, Validator)
+        ],
+        'keyper_blocks': [
+            peer.threshold_encryption_service.current_block
+            for peer in peers if isinstance(peer, Keyper)
+        ],
+        'collations': [
+            peer.collation_service.next_collation_block
+            for peer in peers if isinstance(peer, Collator)
+        ],
+        'stored_items': [len(peer.distributor.fetched_items) for peer in peers],
+        'duplicate_download_bytes': [peer.distributor.duplicate_download_bytes for peer in peers],
+    }
+
+
+def summarize(duration, wall_time, counters, metrics):
+    """Summary of a run, from the counters of all peers and the metrics."""
+    validator_blocks = min(counters['validator_blocks'])
+    summary = {
+        'validator_blocks': validator_blocks,
+        'keyper_blocks': min(counters['keyper_blocks']),
+        'collations': max(counters['collations']),
+        'block_time': duration / validator_blocks if validator_blocks else float('inf'),
+        'stored_items': sum(counters['stored_items']),
+        'duplicate_bytes_per_s': sum(counters['duplicate_download_bytes']) / duration,
+        'wall_time': wall_time,
+    }
+    # median duration of each phase over all peers and blocks
+    for phase, durations_by_block in metrics.phase_durations(finality_votes()).items():
+        durations = sorted(chain.from_iterable(durations_by_block.values()))
+        summary[phase + '_p50'] = percentile(durations, 50)
+    return summary
 
 
 if __name__ == '__main__':
-    logging.basicConfig(
-        stream=sys.stdout,
-        level=logging.INFO
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', type=float, default=50, help='simulated seconds')
+    parser.add_argument('--quiet', action='store_true', help="don't log, e.g. for benchmarking")
+    parser.add_argument('--debug', action='store_true', help='log every message as well')
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='report which processes the processed events and the time spent on them belong to'
     )
-    structlog.configure(
-        processors=[
-            LogFilter({
-                # 'node': lambda p: isinstance(p, Keyper)
-                # 'service': lambda s: s == ItemDistributorService
-            }),
-            structlog.processors.StackInfoRenderer(),
-            structlog.processors.format_exc_info,
-            structlog.dev.ConsoleRenderer(colors=True)
-        ],
-        logger_factory=structlog.stdlib.LoggerFactory()
+    parser.add_argument('--trace', metavar='FILE', help='record all messages to a trace file')
+    parser.add_argument(
+        '--partitions',
+        type=int,
+        default=config.PARTITIONS,
+        help='split the network into this many partitions simulated in parallel processes (needs '
+        "the 'store_and_forward' connection model)"
     )
+    args = parser.parse_args()
+
+    if args.trace:
+        config.TRACE_FILE = args.trace
+    config.PARTITIONS = args.partitions
+    if args.quiet:
+        logs.silence()
+    else:
+        logs.configure(
+            logging.DEBUG if args.debug else logging.INFO,
+            # nodes=lambda p: isinstance(p, Keyper),
+            # services=lambda s: s == ItemDistributorService.__name__,
+        )
 
-    env = simpy.Environment()
-    users, collator, keypers, validators = full_network(env)
-    for peer in users + [collator] + keypers + validators:
-        peer.start()
     # class M:
     #     size = 10
     # from main import *
@@ -51,4 +132,12 @@ if __name__ == '__main__':
     # peer3 = Peer(env, 10, 5)
     # env.process(peer1.send(M(), peer2))
     # env.process(peer1.send(M(), peer3))
-    env.run(50)
+    env = ProfilingEnvironment() if args.profile else None
+    summary, metrics = run(args.duration, env)
+    for name, value in summary.items():
+        print('{}: {}'.format(name, value))
+    print(metrics.format_phases(finality_votes()))
+    if metrics.env is not None:
+        print(PropagationTracker.for_env(metrics.env).format())
+    if args.profile:
+        print(env.report())
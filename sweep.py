@@ -0,0 +1,154 @@
+"""Run the simulation for a grid of config overrides and several seeds in parallel.
+
+Example: `python sweep.py -p N_USERS 50 100 200 -p USER_UPLINK '0.1 * MBIT' 'MBIT' --seeds 5`
+
+Override values are Python expressions evaluated in the namespace of `config`. Every run happens
+in a fresh process, so it starts from the unmodified config and doesn't share any state with the
+others.
+"""
+import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import csv
+from itertools import chain, product
+import math
+import multiprocessing
+import statistics
+import sys
+
+import config
+import logs
+
+
+# two-sided 95% quantiles of Student's t-distribution by degrees of freedom
+T_QUANTILES = {
+    1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306, 9: 2.262,
+    10: 2.228, 11: 2.201, 12: 2.179, 13: 2.160, 14: 2.145, 15: 2.131, 16: 2.120, 17: 2.110,
+    18: 2.101, 19: 2.093, 20: 2.086, 25: 2.060, 30: 2.042, 40: 2.021, 60: 2.000, 120: 1.980,
+}
+
+
+def t_quantile(degrees_of_freedom):
+    """Two-sided 95% quantile of the t-distribution, using the next smaller tabulated value."""
+    return T_QUANTILES[max(df for df in T_QUANTILES if df <= degrees_of_freedom)]
+
+
+def confidence_interval(values):
+    """Mean and half width of the 95% confidence interval of the mean of some samples."""
+    mean = statistics.fmean(values)
+    if len(values) < 2 or not all(math.isfinite(value) for value in values):
+        return mean, math.nan
+    return mean, t_quantile(len(values) - 1) * statistics.stdev(values) / math.sqrt(len(values))
+
+
+def run_scenario(overrides, seed, duration):
+    """Apply config overrides and run a single simulation (in a worker process)."""
+    for name, expression in overrides:
+        setattr(config, name, eval(expression, vars(config)))
+    config.SEED = seed
+
+    import sim  # only now, as the simulation modules read parts of the config at import time
+    logs.silence()
+    summary, _ = sim.run(duration)
+    return summary
+
+
+def scenarios(parameters):
+    """All combinations of parameter values as tuples of (config name, value expression).
+
+    `parameters` is a list of (config name, list of value expressions).
+    """
+    names = [name for name, _ in parameters]
+    return [tuple(zip(names, values)) for values in product(*(values for _, values in parameters))]
+
+
+def sweep(parameters, seeds, duration, workers=None):
+    """Run all scenarios for a number of seeds.
+
+    Yields tuples of overrides, seed and summary in the order in which the runs finish.
+    """
+    # spawn a new interpreter for every run so that module globals start out fresh
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        max_tasks_per_child=1
+    ) as executor:
+        futures = {
+            executor.submit(run_scenario, overrides, seed, duration): (overrides, seed)
+            for overrides in scenarios(parameters)
+            for seed in seeds
+        }
+        for future in as_completed(futures):
+            overrides, seed = futures[future]
+            yield overrides, seed, future.result()
+
+
+def print_table(results):
+    """Print mean and confidence interval of every metric for each scenario, in input order."""
+    summaries_by_scenario = defaultdict(list)
+    for overrides, seed, summary in results:
+        summaries_by_scenario[overrides].append(summary)
+
+    for overrides, summaries in summaries_by_scenario.items():
+        print(', '.join('{}={}'.format(name, value) for name, value in overrides) or 'defaults')
+        print('{:>10} runs'.format(len(summaries)))
+        # not every run reports every metric, e.g. phases of blocks that were never reached
+        for metric in dict.fromkeys(chain.from_iterable(summaries)):
+            mean, half_width = confidence_interval(
+                [summary[metric] for summary in summaries if metric in summary]
+            )
+            print('{:>10.4g} +- {:<10.2g} {}'.format(mean, half_width, metric))
+
+
+def write_csv(results, f):
+    """Write one row per run."""
+    rows = [dict(overrides, seed=seed, **summary) for overrides, seed, summary in results]
+    writer = csv.DictWriter(f, fieldnames=list(dict.fromkeys(chain.from_iterable(rows))))
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        '-p', '--parameter',
+        nargs='+',
+        action='append',
+        default=[],
+        metavar=('NAME', 'VALUE'),
+        help='config name followed by the values to try'
+    )
+    parser.add_argument('--seeds', type=int, default=3, help='number of seeds per scenario')
+    parser.add_argument('--duration', type=float, default=200, help='simulated seconds per run')
+    parser.add_argument('--workers', type=int, help='number of processes (default: all cores)')
+    parser.add_argument('--csv', help='file to write the results of the individual runs to')
+    args = parser.parse_args()
+
+    parameters = []
+    for name, *values in args.parameter:
+        if not hasattr(config, name):
+            parser.error('unknown config value {!r}'.format(name))
+        if not values:
+            parser.error('no values given for {}'.format(name))
+        parameters.append((name, values))
+
+    results = []
+    order = {overrides: n for n, overrides in enumerate(scenarios(parameters))}
+    n_runs = len(order) * args.seeds
+    for overrides, seed, summary in sweep(
+        parameters,
+        range(config.SEED, config.SEED + args.seeds),
+        args.duration,
+        args.workers
+    ):
+        results.append((overrides, seed, summary))
+        print('finished {}/{} runs'.format(len(results), n_runs), file=sys.stderr)
+
+    results.sort(key=lambda result: (order[result[0]], result[1]))
+    print_table(results)
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            write_csv(results, f)
@@ -0,0 +1,57 @@
+"""Differential test of `channels` against the list-based reference in `main`.
+
+Random sequences of reservations are made both on `Channel` objects with `reserve` and on plain
+timelines with `calc_charge` and `charge_channel`, the way peers did before channels were
+indexed. Arrival times and the resulting timelines have to be identical.
+
+Run with `python -m pytest test_channels.py`.
+"""
+from itertools import dropwhile
+import math
+from random import Random
+
+import pytest
+
+from channels import Channel, calc_channel_charge, reserve
+from main import calc_charge, charge_channel
+
+
+N_SEEDS = 200
+N_RESERVATIONS = 300
+
+
+def reserve_reference(message_size, timelines, indices, now):
+    """Reserve on list timelines in place of the indexed ones and return the arrival time."""
+    charge = calc_charge(message_size, [timelines[i] for i in indices], now)
+    for i in indices:
+        timeline = charge_channel(timelines[i], charge)
+        timelines[i] = list(dropwhile(lambda segment: segment[1] < now, timeline))
+    return charge[-1][1]
+
+
+@pytest.mark.parametrize('seed', range(N_SEEDS))
+def test_reserve_matches_reference(seed):
+    random = Random(seed)
+    bandwidths = [random.choice([1e3, 12.8e3, 128e3, 1.28e6]) for _ in range(6)]
+    channels = [Channel(bandwidth) for bandwidth in bandwidths]
+    timelines = [[(bandwidth, math.inf)] for bandwidth in bandwidths]
+
+    now = 0
+    for _ in range(N_RESERVATIONS):
+        now += random.choice([0, 0, random.expovariate(10)])
+        # usually the uplink of a sender and the downlink of a receiver, sometimes a single one
+        indices = random.sample(range(len(channels)), random.choice([1, 2, 2, 2]))
+        message_size = random.choice([0, 20, 200, random.uniform(1, 1e5)])
+
+        for i in indices:
+            channels[i].prune(now)
+        expected_charge = calc_charge(message_size, [timelines[i] for i in indices], now)
+        charge = calc_channel_charge(message_size, [channels[i] for i in indices], now)
+        assert charge == expected_charge
+
+        arrival_time = reserve(message_size, [channels[i] for i in indices], now)
+        expected_arrival_time = reserve_reference(message_size, timelines, indices, now)
+        assert arrival_time == expected_arrival_time
+        for i in indices:
+            assert list(channels[i]) == timelines[i]
+
@@ -0,0 +1,72 @@
+"""Test of `flows.FlowNetwork` against a max-min fair allocation computed from scratch.
+
+Flows over random links start at random times. Whenever all events at a point in time have been
+processed, the rates of the flows in transmission have to be the max-min fair allocation of all
+links, as computed by global progressive filling.
+
+Run with `python -m pytest test_flows.py`.
+"""
+import math
+from random import Random
+
+import pytest
+import simpy
+
+from flows import FlowNetwork, Link
+
+
+N_SEEDS = 100
+N_FLOWS = 60
+
+
+def max_min_rates(flows):
+    """Max-min fair rates of flows, by progressive filling over all their links."""
+    rates = {}
+    capacities = {}
+    unfrozen = {}
+    for flow in flows:
+        for link in flow.links:
+            capacities[link] = link.capacity
+            unfrozen[link] = unfrozen.get(link, 0) + 1
+    while len(rates) < len(flows):
+        link = min(
+            (link for link in capacities if unfrozen[link]),
+            key=lambda link: capacities[link] / unfrozen[link]
+        )
+        share = capacities[link] / unfrozen[link]
+        for flow in flows:
+            if flow not in rates and link in flow.links:
+                rates[flow] = share
+                for other_link in flow.links:
+                    capacities[other_link] -= share
+                    unfrozen[other_link] -= 1
+    return rates
+
+
+@pytest.mark.parametrize('seed', range(N_SEEDS))
+def test_rates_are_max_min_fair(seed):
+    random = Random(seed)
+    env = simpy.Environment()
+    network = FlowNetwork.for_env(env)
+    links = [Link(random.choice([10, 20, 50, 100])) for _ in range(8)]
+    flows = []
+
+    def start_flows():
+        for _ in range(N_FLOWS):
+            yield env.timeout(random.choice([0, random.expovariate(1)]))
+            flow_links = random.sample(links, random.choice([1, 2, 2, 3]))
+            flows.append(network.start_flow(random.uniform(1, 200), flow_links))
+
+    env.process(start_flows())
+    n_checks = 0
+    while env.peek() < math.inf:
+        env.step()
+        if env.peek() == env.now:
+            continue  # more events at this time
+        active_flows = [flow for flow in flows if not flow.finished]
+        expected_rates = max_min_rates(active_flows)
+        for flow in active_flows:
+            assert flow.rate == pytest.approx(expected_rates[flow], rel=1e-6, abs=1e-9)
+        n_checks += 1
+    assert all(flow.finished for flow in flows)
+    assert n_checks > N_FLOWS
@@ -0,0 +1,48 @@
+"""Test that partitioned runs give the same results as unpartitioned ones.
+
+Every run is made in a fresh interpreter, as a process should only run one simulation.
+
+Run with `python -m pytest test_parallel.py`.
+"""
+import pytest
+
+from bench import run_in_process
+import config
+import parallel
+
+
+DURATION = 20
+
+
+def run_summary(config_values):
+    """Summary of a run with some config values, without the values that depend on the wall time
+    and the number of partitions."""
+    for name, value in config_values.items():
+        setattr(config, name, value)
+    import logs
+    import sim
+
+    logs.silence()
+    summary, _ = sim.run(DURATION)
+    del summary['wall_time']
+    summary.pop('windows', None)
+    return summary
+
+
+@pytest.mark.parametrize('config_values', [
+    {},
+    {'TX_ARRIVALS': 'poisson', 'DISSEMINATION_STRATEGIES': {'Vote': ('hybrid', 2)}},
+])
+def test_partitions_match_single_process(config_values):
+    config_values = dict(config_values, CONNECTION_MODEL='store_and_forward', LATENCY=0.02)
+    expected_summary = run_in_process(run_summary, dict(config_values, PARTITIONS=1))
+    summary = run_in_process(run_summary, dict(config_values, PARTITIONS=2))
+    assert summary == expected_summary
+    assert expected_summary['validator_blocks'] > 0
+
+
+def test_partitions_need_store_and_forward(monkeypatch):
+    monkeypatch.setattr(config, 'PARTITIONS', 2)
+    monkeypatch.setattr(config, 'CONNECTION_MODEL', 'cut_through')
+    with pytest.raises(ValueError):
+        parallel.run(DURATION)
@@ -0,0 +1,211 @@
+"""Generators for the connections between peers, and edge list files to store them in.
+
+Topologies are lists of edges `(i, j)` between peers given by their index in the network (users,
+collator, keypers, validators, in this order). All generators take time proportional to the
+number of edges and draw from a given random number generator.
+
+An edge list file starts with `MAGIC`, followed by the length of a JSON header as unsigned 32 bit
+integer, the header and the edges as unsigned 32 bit integers. The header holds the parameters
+the topology was generated from. `network_edges` keeps one file per set of parameters, named
+after a digest of them, so that e.g. the runs of a sweep over seeds or network sizes each
+generate their topology once and reuse it afterwards.
+"""
+from array import array
+import hashlib
+import json
+import os
+import struct
+import tempfile
+
+import config
+import rng
+
+
+MAGIC = b'NSTOPO01'
+HEADER_LENGTH = struct.Struct('<I')
+
+
+def random_graph(n, degree, random):
+    """Every peer connects to random others until it has at least `degree` connections.
+
+    This is how peers have been connected originally and it produces the same graph for the same
+    random numbers.
+    """
+    neighbours = [set() for _ in range(n)]
+    edges = []
+    for i in range(n):
+        while len(neighbours[i]) < degree:
+            j = random.randrange(n)
+            if j != i and j not in neighbours[i]:
+                neighbours[i].add(j)
+                neighbours[j].add(i)
+                edges.append((i, j))
+    return edges
+
+
+def random_regular_graph(n, degree, random):
+    """Approximately regular random graph in which (almost) every peer has `degree` connections.
+
+    Connection stubs are paired at random (configuration model). Pairs that would connect a peer
+    with itself or duplicate a connection are dropped instead of retried, which leaves a few
+    peers with a slightly lower degree.
+    """
+    stubs = [i for i in range(n) for _ in range(degree)]
+    random.shuffle(stubs)
+    edges = set()
+    for i, j in zip(stubs[::2], stubs[1::2]):
+        if i != j:
+            edges.add((min(i, j), max(i, j)))
+    return sorted(edges)
+
+
+def watts_strogatz_graph(n, degree, rewiring, random):
+    """Small-world graph built from a ring of peers.
+
+    Every peer is connected to its `degree` nearest neighbours (rounded down to an even number)
+    and each of these connections is rewired to a random peer with probability `rewiring`.
+    """
+    half_degree = max(1, degree // 2)
+    neighbours = [set() for _ in range(n)]
+    for i in range(n):
+        for offset in range(1, half_degree + 1):
+            j = (i + offset) % n
+            if j != i:
+                neighbours[i].add(j)
+                neighbours[j].add(i)
+    for i in range(n):
+        for offset in range(1, half_degree + 1):
+            j = (i + offset) % n
+            if j not in neighbours[i] or random.random() >= rewiring:
+                continue
+            k = random.randrange(n)
+            if k == i or k in neighbours[i]:
+                continue  # keep the original connection
+            neighbours[i].remove(j)
+            neighbours[j].remove(i)
+            neighbours[i].add(k)
+            neighbours[k].add(i)
+    return [(i, j) for i in range(n) for j in neighbours[i] if i < j]
+
+
+def barabasi_albert_graph(n, degree, random):
+    """Scale-free graph grown by preferential attachment.
+
+    Every new peer connects to `degree // 2` existing ones, chosen with a probability
+    proportional to their degree, so that the average degree is about `degree`.
+    """
+    m = max(1, degree // 2)
+    edges = []
+    # every peer appears in this list once per connection, so drawing from it prefers hubs
+    endpoints = list(range(min(m, n)))
+    for i in range(m, n):
+        targets = set()
+        while len(targets) < m:
+            targets.add(random.choice(endpoints))
+        for j in targets:
+            edges.append((j, i))
+            endpoints.extend((i, j))
+    return edges
+
+
+def clique(indices):
+    """Connect every peer of a group with every other."""
+    indices = list(indices)
+    return [(i, j) for n, i in enumerate(indices) for j in indices[n + 1:]]
+
+
+GENERATORS = {
+    'random': random_graph,
+    'random_regular': random_regular_graph,
+    'watts_strogatz': watts_strogatz_graph,
+    'barabasi_albert': barabasi_albert_graph,
+}
+
+
+def generate(spec, n, degree, random):
+    """Create a graph from a config entry such as `'random'` or `('watts_strogatz', 0.1)`."""
+    if isinstance(spec, str):
+        spec = (spec,)
+    name, *args = spec
+    return GENERATORS[name](n, degree, *args, random)
+
+
+def save(path, parameters, edges):
+    """Write a graph and the parameters it was generated from (anything JSON can store)."""
+    header = json.dumps(parameters, sort_keys=True).encode()
+    data = array('I')
+    for edge in edges:
+        data.extend(edge)
+    # write to a temporary file first, so that parallel runs never read a half-written file
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+        f.write(MAGIC)
+        f.write(HEADER_LENGTH.pack(len(header)))
+        f.write(header)
+        data.tofile(f)
+    os.replace(f.name, path)
+
+
+def load(path):
+    """Read a graph written by `save` and return its parameters and edges."""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not an edge list file'.format(path))
+        header_length, = HEADER_LENGTH.unpack(f.read(HEADER_LENGTH.size))
+        parameters = json.loads(f.read(header_length).decode())
+        data = array('I')
+        data.frombytes(f.read())
+    return parameters, list(zip(data[::2], data[1::2]))
+
+
+def network_parameters(n):
+    """Everything the topology of a network with `n` peers depends on, as stored in files."""
+    parameters = {
+        'peers': n,
+        'topology': config.TOPOLOGY,
+        'degree': config.N_USER_CONNECTIONS,
+        'connect_keypers': config.CONNECT_KEYPERS,
+        'connect_validators': config.CONNECT_VALIDATORS,
+        'seed': config.SEED,
+    }
+    # as read back from a file, e.g. with lists instead of tuples
+    return json.loads(json.dumps(parameters))
+
+
+def cache_path(prefix, parameters):
+    """File to cache the topology generated from some parameters in."""
+    digest = hashlib.sha256(json.dumps(parameters, sort_keys=True).encode()).hexdigest()
+    return '{}.{}'.format(prefix, digest[:16])
+
+
+def network_edges(n_users, n_keypers, n_validators):
+    """The connections of the network described by `config`.
+
+    If `config.TOPOLOGY_FILE` is set, the topology is read from the file with this prefix and a
+    digest of its parameters as suffix, or created and stored there if it doesn't exist yet.
+    """
+    n = n_users + 1 + n_keypers + n_validators
+    parameters = network_parameters(n)
+    path = None
+    if config.TOPOLOGY_FILE is not None:
+        path = cache_path(config.TOPOLOGY_FILE, parameters)
+    if path is not None and os.path.exists(path):
+        stored_parameters, edges = load(path)
+        if stored_parameters != parameters:  # only if the file has been replaced by another one
+            raise ValueError('{} holds a topology generated with {} instead of {}'.format(
+                path,
+                stored_parameters,
+                parameters
+            ))
+        return edges
+
+    edges = generate(config.TOPOLOGY, n, config.N_USER_CONNECTIONS, rng.stream('topology'))
+    keypers = range(n_users + 1, n_users + 1 + n_keypers)
+    validators = range(n_users + 1 + n_keypers, n)
+    if config.CONNECT_KEYPERS:
+        edges += clique(keypers)
+    if config.CONNECT_VALIDATORS:
+        edges += clique(validators)
+    if path is not None:
+        save(path, parameters, edges)
+    return edges
@@ -0,0 +1,247 @@
+"""Binary traces of all messages and distributed items of a run.
+
+A trace file starts with `MAGIC` and continues with fixed-width little-endian records, see
+`RECORD_FIELDS`. Messages are recorded once per item they carry (or once if they carry none),
+with the message size only in the first of these records, so that summing up the sizes gives
+the number of bytes. Requests only carry hashes, so their records have no item type and block.
+Peers are identified by their `node_id`, which follows the order in which peers are created,
+i.e. the order of `networks.full_network` (users, collator, keypers, validators).
+
+Records are written in chunks by `Tracer`. `load` memory-maps a trace as a NumPy structured
+array, so that even very large traces can be filtered and aggregated with NumPy operations
+without reading them into memory. Only the reader needs NumPy.
+
+Run `python tracing.py <file>` for an overview of a trace.
+"""
+import argparse
+import struct
+from weakref import WeakKeyDictionary
+
+
+MAGIC = b'NSTRACE1'
+
+# (name, NumPy type, struct format)
+RECORD_FIELDS = [
+    ('time', '<f8', 'd'),
+    ('event', 'u1', 'B'),
+    ('message_type', 'u1', 'B'),
+    ('item_type', 'u1', 'B'),
+    ('sender', '<u4', 'I'),
+    ('receiver', '<u4', 'I'),
+    ('size', '<u4', 'I'),
+    ('block', '<i4', 'i'),
+    ('hash', '<i8', 'q'),
+]
+RECORD = struct.Struct('<' + ''.join(fmt for _, _, fmt in RECORD_FIELDS))
+
+# events
+SEND = 0  # a peer starts to send a message
+RECEIVE = 1  # a message has arrived
+DISTRIBUTE = 2  # a peer has created an item and starts to distribute it
+EVENT_NAMES = ['send', 'receive', 'distribute']
+
+MESSAGE_TYPES = ['AnnounceItems', 'RequestItems', 'SendItems']
+MESSAGE_TYPE_CODES = {name: code for code, name in enumerate(MESSAGE_TYPES)}
+
+NONE = 255  # for message and item types
+NO_PEER = 2**32 - 1
+NO_BLOCK = -1
+
+
+class Tracer(object):
+    """Writes the trace of a simulation environment to a file."""
+
+    tracers = WeakKeyDictionary()
+
+    def __init__(self, env, path, chunk_size=2**16):
+        self.env = env
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.chunk_size = chunk_size  # number of records written at once
+        self.buffer = bytearray(chunk_size * RECORD.size)
+        self.n_buffered = 0
+
+    @classmethod
+    def for_env(cls, env, path):
+        """Get the tracer of a simulation environment, creating it if necessary."""
+        if env not in cls.tracers:
+            cls.tracers[env] = cls(env, path)
+        return cls.tracers[env]
+
+    def record(self, event, message_type, item_type, sender, receiver, size, block, hash_):
+        """Add a record (the size is rounded to whole bytes)."""
+        RECORD.pack_into(
+            self.buffer,
+            self.n_buffered * RECORD.size,
+            self.env.now,
+            event,
+            message_type,
+            item_type,
+            sender,
+            receiver,
+            round(size),
+            block,
+            hash_
+        )
+        self.n_buffered += 1
+        if self.n_buffered == self.chunk_size:
+            self.flush()
+
+    def record_message(self, event, message, sender, receiver):
+        """Record a message that is being sent or has been received."""
+        message_type = MESSAGE_TYPE_CODES.get(message.__class__.__name__, NONE)
+        size = message.size
+        items = getattr(message, 'items', None)
+        if items is not None:
+            for item in items:
+                self.record(
+                    event,
+                    message_type,
+                    item.type_id,
+                    sender.node_id,
+                    receiver.node_id,
+                    size,
+                    item.block,
+                    item.hash_
+                )
+                size = 0
+        for hash_ in getattr(message, 'hashes', ()):
+            self.record(
+                event,
+                message_type,
+                NONE,
+                sender.node_id,
+                receiver.node_id,
+                size,
+                NO_BLOCK,
+                hash_
+            )
+            size = 0
+        if size:  # the message didn't contain anything
+            self.record(
+                event,
+                message_type,
+                NONE,
+                sender.node_id,
+                receiver.node_id,
+                size,
+                NO_BLOCK,
+                0
+            )
+
+    def record_item(self, item, peer):
+        """Record that a peer has started to distribute a new item."""
+        self.record(
+            DISTRIBUTE,
+            NONE,
+            item.type_id,
+            peer.node_id,
+            NO_PEER,
+            item.size,
+            item.block,
+            item.hash_
+        )
+
+    def flush(self):
+        self.file.write(memoryview(self.buffer)[:self.n_buffered * RECORD.size])
+        self.n_buffered = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def record_dtype():
+    import numpy
+    return numpy.dtype([(name, numpy_type) for name, numpy_type, _ in RECORD_FIELDS])
+
+
+def load(path):
+    """Memory-map a trace file as a read-only NumPy structured array."""
+    import numpy
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a trace file'.format(path))
+    return numpy.memmap(path, dtype=record_dtype(), mode='r', offset=len(MAGIC))
+
+
+def arrival_times(records, event=RECEIVE, include_creators=True):
+    """For each item, the time it first reached each peer, as parallel arrays of hash, peer, time.
+
+    Only items carried in SendItems messages are considered. The creator of an item is counted
+    with the time it distributed the item, or left out with `include_creators=False`.
+    """
+    import numpy
+    received = records[
+        (records['event'] == event) &
+        (records['message_type'] == MESSAGE_TYPE_CODES['SendItems'])
+    ]
+    distributed = records[records['event'] == DISTRIBUTE]
+    hashes = numpy.concatenate([received['hash'], distributed['hash']])
+    peers = numpy.concatenate([received['receiver'], distributed['sender']])
+    times = numpy.concatenate([received['time'], distributed['time']])
+    # sort by item, peer and time and keep the first entry of each item and peer
+    order = numpy.lexsort((times, peers, hashes))
+    hashes, peers, times = hashes[order], peers[order], times[order]
+    first = numpy.ones(len(hashes), dtype=bool)
+    first[1:] = (hashes[1:] != hashes[:-1]) | (peers[1:] != peers[:-1])
+    hashes, peers, times = hashes[first], peers[first], times[first]
+    if not include_creators and len(distributed):
+        order = numpy.argsort(distributed['hash'], kind='stable')
+        created_hashes = distributed['hash'][order]
+        creators = distributed['sender'][order]
+        indices = numpy.minimum(numpy.searchsorted(created_hashes, hashes), len(created_hashes) - 1)
+        by_creator = (created_hashes[indices] == hashes) & (creators[indices] == peers)
+        hashes, peers, times = hashes[~by_creator], peers[~by_creator], times[~by_creator]
+    return hashes, peers, times
+
+
+def summary(records, item_type_names):
+    """Overview of a trace: bytes by message type and propagation delays by item type."""
+    import numpy
+    lines = ['{} records, {:.1f} simulated seconds'.format(
+        len(records),
+        float(records['time'][-1]) if len(records) else 0
+    )]
+
+    sent = records[records['event'] == SEND]
+    lines.append('sent messages (bytes):')
+    for code, name in enumerate(MESSAGE_TYPES):
+        sizes = sent['size'][sent['message_type'] == code]
+        lines.append('{:>20}: {:>14}'.format(name, int(sizes.sum(dtype=numpy.uint64))))
+
+    # look up the creation of each arrived item
+    distributed = records[records['event'] == DISTRIBUTE]
+    order = numpy.argsort(distributed['hash'], kind='stable')
+    created_hashes = distributed['hash'][order]
+    creation_times = distributed['time'][order]
+    item_types = distributed['item_type'][order]
+    hashes, _, times = arrival_times(records, include_creators=False)
+    indices = numpy.minimum(numpy.searchsorted(created_hashes, hashes), len(created_hashes) - 1)
+    if len(created_hashes):
+        known = created_hashes[indices] == hashes
+    else:
+        known = numpy.zeros(len(hashes), dtype=bool)
+    delays = times[known] - creation_times[indices[known]]
+    delay_types = item_types[indices[known]]
+
+    lines.append('delay between creation and arrival at a peer (s, p50/p90/max):')
+    for item_type in numpy.unique(delay_types).tolist():
+        type_delays = delays[delay_types == item_type]
+        lines.append('{:>20}: {:8.2f} {:8.2f} {:8.2f}'.format(
+            item_type_names.get(item_type, str(item_type)),
+            numpy.percentile(type_delays, 50),
+            numpy.percentile(type_delays, 90),
+            type_delays.max()
+        ))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show an overview of a trace file.')
+    parser.add_argument('path')
+    args = parser.parse_args()
+
+    from main import ITEM_TYPES
+    item_type_names = {item_type.type_id: name for name, item_type in ITEM_TYPES.items()}
+    print(summary(load(args.path), item_type_names))
@@ -1,8 +1,11 @@
 from collections import defaultdict
 from itertools import count
-import random
+from weakref import WeakKeyDictionary
 
+import config
 from main import Peer, Service, Transaction, EncKeyShare
+import metrics
+import rng
 
 
 class User(Peer):
@@ -18,30 +21,45 @@ class User(Peer):
 
 
 class TxSpawnService(Service):
-    """Creates transactions at constant intervals and passes them to the distributor.
+    """Creates transactions and passes them to the distributor.
 
-    It watches for collations to know which will be the next block.
+    With `config.TX_ARRIVALS` set to `'periodic'`, transactions are created at constant
+    intervals by a process of this service. Otherwise, `TransactionArrivals` creates them for all
+    users. With `config.TX_BUNDLE_SIZE` > 1, that many transactions are created at once as a
+    bundle, at correspondingly longer intervals. It watches for collations to know which will be
+    the next block.
     """
 
     def __init__(self, env, peer, spawn_interval, keyper_threshold):
         super().__init__(env, peer)
-        self.spawn_interval = spawn_interval
+        self.bundle_size = config.TX_BUNDLE_SIZE
+        self.spawn_interval = spawn_interval * self.bundle_size
         self.current_block = 0
         self.keyper_threshold = keyper_threshold
+        self.started = False
+        if config.TX_ARRIVALS != 'periodic':
+            TransactionArrivals.for_env(self.env, self.spawn_interval).add(self)
 
     def start(self):
-        enc_watcher = self.env.process(self.watch_enc_key_shares())
-        transaction_creator = self.env.process(self.create_transactions())
-        yield self.env.all_of([enc_watcher, transaction_creator])
+        self.started = True
+        processes = [self.env.process(self.watch_enc_key_shares())]
+        if config.TX_ARRIVALS == 'periodic':
+            processes.append(self.env.process(self.create_transactions()))
+        yield self.env.all_of(processes)
 
     def create_transactions(self):
-        yield self.env.timeout(random.random() * self.spawn_interval)
+        arrivals = rng.stream('arrivals/{}'.format(self.peer.instance_number))
+        nonces = rng.stream('nonces/{}'.format(self.peer.instance_number))
+        yield self.env.timeout(arrivals.random() * self.spawn_interval)
         while True:
             # self.logger.info('sending tx', time=self.env.now)
-            transaction = Transaction(self.peer.instance_number)
-            self.peer.distributor.distribute(transaction)
+            self.create_transaction(nonces.randint(0, 2**32))
             yield self.env.timeout(self.spawn_interval)
 
+    def create_transaction(self, nonce):
+        transaction = Transaction(self.current_block, nonce, self.bundle_size)
+        self.peer.distributor.distribute(transaction)
+
     def watch_enc_key_shares(self):
         enc_key_shares = set()
         enc_key_share_senders = set()
@@ -54,6 +72,101 @@ class TxSpawnService(Service):
             enc_key_shares |= shares
             enc_key_share_senders |= set(share.sender for share in shares)
             if len(enc_key_share_senders) >= self.keyper_threshold:
+                self.record(metrics.ENC_KEY_RECEIVED, self.current_block)
                 self.current_block += 1
                 enc_key_shares = set()
                 enc_key_share_senders = set()
+
+
+class TransactionArrivals(object):
+    """Creates the transactions of all users of an environment in a single process.
+
+    Instead of one process and one scheduled event per user, the arrivals of all users are
+    generated as one stream: the gaps between arrivals are drawn in batches from the
+    distribution given by `config.TX_ARRIVALS` and every arrival is assigned to a random user.
+    The mean gap is the spawn interval of a user divided by the number of users, so the total
+    rate is the same as with periodic arrivals.
+
+    Batches are drawn with a NumPy generator seeded from the `'arrivals'` stream. NumPy is
+    optional, without it the values are drawn one by one from the stream itself.
+
+    All users register when they are created, including those simulated by other partitions (see
+    `parallel`), so that every partition draws the same arrivals. Only users that have been
+    started get their transactions.
+    """
+
+    schedulers = WeakKeyDictionary()
+    batch_size = 1024
+
+    def __init__(self, env, spawn_interval):
+        self.env = env
+        self.spawn_interval = spawn_interval  # mean time between two arrivals of the same user
+        self.services = []
+        self.random = rng.stream('arrivals')
+        try:
+            import numpy
+        except ImportError:
+            self.generator = None
+        else:
+            self.generator = numpy.random.default_rng(self.random.getrandbits(128))
+        spec = config.TX_ARRIVALS
+        if isinstance(spec, str):
+            spec = (spec,)
+        name, *args = spec
+        self.draw_gaps = INTER_ARRIVAL_DISTRIBUTIONS[name](self.random, self.generator, *args)
+        # created with the first user, so all users have registered once it draws the first ones
+        self.env.process(self.create_transactions())
+
+    @classmethod
+    def for_env(cls, env, spawn_interval):
+        """Get the scheduler of a simulation environment, creating it if necessary."""
+        if env not in cls.schedulers:
+            cls.schedulers[env] = cls(env, spawn_interval)
+        return cls.schedulers[env]
+
+    def add(self, service):
+        """Create transactions for the user of a `TxSpawnService` once it has been started."""
+        self.services.append(service)
+
+    def draw_users(self, n_users, size):
+        if self.generator is not None:
+            return self.generator.integers(n_users, size=size).tolist()
+        return [self.random.randrange(n_users) for _ in range(size)]
+
+    def draw_nonces(self, size):
+        if self.generator is not None:
+            return self.generator.integers(2**32, size=size, endpoint=True).tolist()
+        return [self.random.randint(0, 2**32) for _ in range(size)]
+
+    def create_transactions(self):
+        services = self.services
+        while True:
+            n_users = len(services)
+            gaps = self.draw_gaps(self.spawn_interval / n_users, self.batch_size)
+            users = self.draw_users(n_users, self.batch_size)
+            nonces = self.draw_nonces(self.batch_size)
+            for gap, user, nonce in zip(gaps, users, nonces):
+                yield self.env.timeout(gap)
+                if services[user].started:
+                    services[user].create_transaction(nonce)
+
+
+def poisson_gaps(random, generator):
+    """Exponentially distributed gaps, i.e. arrivals form a Poisson process."""
+    if generator is not None:
+        return lambda mean, size: generator.exponential(mean, size).tolist()
+    return lambda mean, size: [random.expovariate(1 / mean) for _ in range(size)]
+
+
+def gamma_gaps(random, generator, shape):
+    """Gamma distributed gaps, burstier than Poisson for shapes below 1 and more regular above."""
+    if generator is not None:
+        return lambda mean, size: generator.gamma(shape, mean / shape, size).tolist()
+    return lambda mean, size: [random.gammavariate(shape, mean / shape) for _ in range(size)]
+
+
+# {name: function(random stream, NumPy generator or None, *args) returning draw(mean, size)}
+INTER_ARRIVAL_DISTRIBUTIONS = {
+    'poisson': poisson_gaps,
+    'gamma': gamma_gaps,
+}
@@ -1,5 +1,6 @@
 from itertools import count
-from main import Peer, Service, Collation, Vote
+from main import Peer, Service, Collation, DecKeyShare, Vote
+import metrics
 
 
 class Validator(Peer):
@@ -23,10 +24,13 @@ class ValidatorService(Service):
         while True:
             logger = self.logger.bind(block=self.current_block)
             yield self.env.process(self.wait_for_collation())
+            self.record(metrics.COLLATION_RECEIVED, self.current_block)
             logger.info('received collation', time=self.env.now)
             yield self.env.process(self.wait_for_dec_key())
+            self.record(metrics.DEC_KEY_RECEIVED, self.current_block)
             logger.info('received decryption key', time=self.env.now)
             self.vote()
+            self.record(metrics.VOTED, self.current_block)
             logger.info('voted', time=self.env.now)
             self.current_block += 1
 
@@ -48,7 +52,7 @@ class ValidatorService(Service):
         dec_keys = set()
         while len(dec_keys) < self.keyper_threshold:
             dec_keys |= yield self.env.process(self.peer.distributor.get_items(
-                Collation.type_id,
+                DecKeyShare.type_id,
                 self.current_block,
                 exclude=dec_keys
             ))